@@ -0,0 +1,259 @@
+# Synthetic data generator and route benchmark for Hermes.
+#
+# Generate a dataset and run the benchmark against it:
+#     python benchmark.py --db sqlite:///bench.db --orders 100000 \
+#         --parts 5000 --lines 1000000
+# Rerun against the same data without regenerating:
+#     python benchmark.py --db sqlite:///bench.db --no-generate
+# Compare the site index against a brute force scan:
+#     python benchmark.py --db sqlite:///bench.db --no-generate --spatial
+import argparse
+import datetime as dt
+import json
+import os
+import random
+import time
+
+os.environ.setdefault('ENV', 'benchmark')
+os.environ.setdefault('FLASK_KEY', 'benchmark')
+os.environ.setdefault('DATABASE_URL', 'sqlite:///bench.db')
+import hermes  # noqa: E402
+
+STATUSES = [status for _, status in hermes.ORDER_STATUSES]
+CHUNK = 10000
+
+
+def fake_geocode(keys):
+    # Stand-in for the Census geocoder, scatters sites around Scranton
+    rng = random.Random(len(keys))
+    return {k: (41.4 + rng.uniform(-0.5, 0.5), -75.6 + rng.uniform(-0.5, 0.5))
+            for k in keys}
+
+
+def insert(model, rows):
+    table = model.__table__
+    for i in range(0, len(rows), CHUNK):
+        hermes.db.session.execute(table.insert(), rows[i:i + CHUNK])
+    hermes.db.session.commit()
+
+
+def generate(args):
+    rng = random.Random(args.seed)
+    db = hermes.db
+    db.drop_all()
+    db.create_all()
+    started = time.time()
+    insert(hermes.Client, [{'cid': i, 'name': 'Client {0}'.format(i),
+                            'description': 'Synthetic client',
+                            'deleted': False}
+                           for i in range(1, args.clients + 1)])
+    insert(hermes.Site, [{'sid': i,
+                          'address': '{0} Main St, Scranton, PA 18503'
+                          .format(i),
+                          'lat': 41.4 + rng.uniform(-0.5, 0.5),
+                          'lon': -75.6 + rng.uniform(-0.5, 0.5),
+                          'geocode_status': 'done', 'deleted': False}
+                         for i in range(1, args.sites + 1)])
+    insert(hermes.Part, [{'pid': i, 'name': 'Part {0}'.format(i),
+                          'description': 'Synthetic part {0}'.format(i),
+                          'units': 'each', 'stock': rng.randint(0, 500),
+                          'reserved': 0, 'deleted': False}
+                         for i in range(1, args.parts + 1)])
+    start = dt.date(2018, 1, 1)
+    insert(hermes.Order, [{'oid': i,
+                           'cid': rng.randint(1, args.clients),
+                           'sid': rng.randint(1, args.sites),
+                           'due': start + dt.timedelta(
+                               days=rng.randint(0, 3 * 365)),
+                           'status': rng.choice(STATUSES),
+                           'deleted': False}
+                          for i in range(1, args.orders + 1)])
+    # Spread the lines over the orders, one line per part per order
+    per_order = max(1, args.lines // args.orders)
+    lines = []
+    otpid = 0
+    for oid in range(1, args.orders + 1):
+        for pid in rng.sample(range(1, args.parts + 1),
+                              min(per_order, args.parts)):
+            otpid += 1
+            lines.append({'otpid': otpid, 'oid': oid, 'pid': pid,
+                          'quantity': rng.randint(1, 20),
+                          'price': round(rng.uniform(0.5, 50), 2),
+                          'deleted': False})
+        if len(lines) >= CHUNK:
+            insert(hermes.OrderToPart, lines)
+            lines = []
+    insert(hermes.OrderToPart, lines)
+    user = hermes.User(username='bench', email='bench@example.com')
+    user.set_pw('bench')
+    db.session.add(user)
+    db.session.commit()
+    hermes.sync_id_sequences()
+    hermes.reconcile_reserved()
+    print('generated {0} orders, {1} lines in {2:.1f}s'.format(
+        args.orders, otpid, time.time() - started))
+
+
+def order_form(oid, rng):
+    # Rebuild what the order page would post, changing a few quantities
+    o = hermes.Order.query.get(oid)
+    form = {'client': o.cid, 'site': o.sid, 'due': o.due, 'status': o.status}
+    for pid, otp in hermes.get_order_lines(oid).items():
+        form['{0}_current'.format(pid)] = otp.quantity
+        form['{0}_price'.format(pid)] = otp.price
+    for key in [k for k in form if k.endswith('_current')][:3]:
+        form[key] = rng.randint(1, 20)
+    return form
+
+
+def run(args):
+    rng = random.Random(args.seed)
+    app = hermes.app
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['user_id'] = str(hermes.User.query.filter_by(
+            username='bench').first().uid)
+        sess['_fresh'] = True
+    max_oid = hermes.db.session.query(
+        hermes.db.func.max(hermes.Order.oid)).scalar()
+    hermes.route_metrics.reset()
+    app.config['INSTRUMENT'] = True
+    app.config['INSTRUMENT_LOG'] = False
+    for _ in range(args.iterations):
+        client.get('/')
+        client.get('/orders/')
+        oid = rng.randint(1, max_oid)
+        client.get('/order/{0}'.format(oid))
+        client.post('/order/{0}'.format(oid),
+                    data=order_form(oid, rng))
+        doomed = rng.sample(range(1, max_oid + 1), args.delete_batch)
+        client.post('/delete_orders/',
+                    data={'delete_{0}'.format(o): 'on' for o in doomed})
+    app.config['INSTRUMENT'] = False
+    return hermes.route_metrics.summary()
+
+
+def brute_within(points, lat, lon, km):
+    res = [(hermes.haversine(lat, lon, plat, plon), sid)
+           for sid, plat, plon in points]
+    return [(sid, d) for d, sid in sorted(res) if d <= km]
+
+
+def brute_nearest(points, lat, lon, k):
+    res = sorted((hermes.haversine(lat, lon, plat, plon), sid)
+                 for sid, plat, plon in points)
+    return [(sid, d) for d, sid in res[:k]]
+
+
+def timed(fn, probes):
+    # Per call latencies in ms plus the results, for checking agreement
+    results = []
+    samples = []
+    for probe in probes:
+        started = time.time()
+        results.append(fn(*probe))
+        samples.append(1000 * (time.time() - started))
+    samples.sort()
+    return results, {'p50': hermes.percentile(samples, 50),
+                     'p99': hermes.percentile(samples, 99)}
+
+
+# Name, SiteIndex method, brute force equivalent, argument, probe points
+SPATIAL_QUERIES = [('within 5km', 'within', brute_within, 5.0, 'near'),
+                   ('nearest 10', 'nearest', brute_nearest, 10, 'near'),
+                   ('far nearest 3', 'nearest', brute_nearest, 3, 'far'),
+                   ('far within 1200km', 'within', brute_within, 1200.0,
+                    'far')]
+
+
+def run_spatial(args):
+    rng = random.Random(args.seed)
+    site = hermes.Site
+    points = [(sid, float(lat), float(lon)) for sid, lat, lon in
+              hermes.db.session.query(site.sid, site.lat, site.lon)
+              .filter(site.deleted == hermes.db.false(),
+                      site.lat.isnot(None))]
+    started = time.time()
+    hermes.site_index.sync(force=True)
+    build = 1000 * (time.time() - started)
+    centers = [(41.4 + rng.uniform(-0.5, 0.5), -75.6 + rng.uniform(-0.5, 0.5))
+               for _ in range(args.iterations)]
+    # Around 1,100 km from the generated sites, where the grid has to
+    # search outward a long way or give up and scan
+    far = [(31.4 + rng.uniform(-0.5, 0.5), -85.6 + rng.uniform(-0.5, 0.5))
+           for _ in range(args.iterations)]
+    summary = {'sites': len(points), 'build ms': build}
+    for name, indexed, brute, arg, probes in SPATIAL_QUERIES:
+        indexed = getattr(hermes.site_index, indexed)
+        probes = far if probes == 'far' else centers
+        index_res, index_ms = timed(indexed, [c + (arg,) for c in probes])
+        brute_res, brute_ms = timed(lambda *a: brute(points, *a),
+                                    [c + (arg,) for c in probes])
+        agree = all([sid for sid, _ in a] == [sid for sid, _ in b]
+                    for a, b in zip(index_res, brute_res))
+        summary[name] = {'index': index_ms, 'brute': brute_ms,
+                         'agree': agree}
+    return summary
+
+
+def report_spatial(summary):
+    print('{0} sites, index built in {1:.1f} ms'.format(
+        summary['sites'], summary['build ms']))
+    print('{0:<19}{1:>12}{2:>12}{3:>12}{4:>12}{5:>7}'.format(
+        'query', 'index p50', 'index p99', 'brute p50', 'brute p99',
+        'agree'))
+    for name, _, _, _, _ in SPATIAL_QUERIES:
+        row = summary[name]
+        print('{0:<19}{1:>12.3f}{2:>12.3f}{3:>12.3f}{4:>12.3f}{5:>7}'.format(
+            name, row['index']['p50'], row['index']['p99'],
+            row['brute']['p50'], row['brute']['p99'], str(row['agree'])))
+
+
+def report(summary):
+    print('{0:<22}{1:>7}{2:>10}{3:>10}{4:>10}{5:>9}'.format(
+        'route', 'count', 'p50 ms', 'p95 ms', 'p99 ms', 'queries'))
+    for endpoint in sorted(summary):
+        row = summary[endpoint]
+        print('{0:<22}{1:>7}{2:>10.1f}{3:>10.1f}{4:>10.1f}{5:>9}'.format(
+            endpoint, row['count'], row['wall']['p50'], row['wall']['p95'],
+            row['wall']['p99'], row['queries']['max']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark Hermes routes')
+    parser.add_argument('--db', default=os.environ['DATABASE_URL'])
+    parser.add_argument('--clients', type=int, default=1000)
+    parser.add_argument('--sites', type=int, default=5000)
+    parser.add_argument('--parts', type=int, default=5000)
+    parser.add_argument('--orders', type=int, default=100000)
+    parser.add_argument('--lines', type=int, default=1000000)
+    parser.add_argument('--iterations', type=int, default=50)
+    parser.add_argument('--delete-batch', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-generate', action='store_true')
+    parser.add_argument('--spatial', action='store_true',
+                        help='benchmark site lookups instead of routes')
+    parser.add_argument('--output', help='append results as JSON lines')
+    args = parser.parse_args()
+
+    app = hermes.app
+    app.config['SQLALCHEMY_DATABASE_URI'] = args.db
+    app.config['GEOCODE_WORKERS'] = 0
+    hermes.census_geocode = fake_geocode
+    with app.app_context():
+        if not args.no_generate:
+            generate(args)
+        summary = run_spatial(args) if args.spatial else run(args)
+    if args.spatial:
+        report_spatial(summary)
+    else:
+        report(summary)
+    if args.output:
+        with open(args.output, 'a') as fid:
+            fid.write(json.dumps({'time': str(dt.datetime.utcnow()),
+                                  'args': vars(args),
+                                  'summary': summary}) + '\n')
+
+
+if __name__ == '__main__':
+    main()
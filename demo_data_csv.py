@@ -1,51 +1,35 @@
-clients = ['cid,name,description,deleted',
-           '1,Doug Dimmadome,Owner of the Dimmsdale Dimmadome,false',
-           '2,Bob Vance,Vance Refrigeration,false',
-           '3,Homer Simpson,Nuclear technician,false']
+clients = ['name,description',
+           'Doug Dimmadome,Owner of the Dimmsdale Dimmadome',
+           'Bob Vance,Vance Refrigeration',
+           'Homer Simpson,Nuclear technician']
 with open('clients.csv', 'w') as fid:
     fid.write('\n'.join(clients))
 
-sites = ['sid,address,deleted',
-         '1,100 Maple Road,false',
-         '2,7 Main Street,false',
-         '3,1600 Pennsylvania Avenue,false']
+sites = ['address',
+         '"811 S Washington Ave, Scranton, PA 18505"',
+         '"100 Adams Ave, Scranton, PA 18503"',
+         '"800 Linden St, Scranton, PA 18510"']
 with open('sites.csv', 'w') as fid:
     fid.write('\n'.join(sites))
 
-orders = ['oid,cid,sid,due,status,deleted',
-          '1,1,1,4 May 2018,Order placed,false',
-          '2,2,2,25 December 2018,Delivery scheduled,false',
-          '3,3,3,1 April 2018,Order completed,false']
+orders = ['cid,sid,due,status',
+          '1,1,2018-05-04,Order placed',
+          '2,2,2018-12-25,Delivery scheduled',
+          '3,3,2018-04-01,Order completed']
 with open('orders.csv', 'w') as fid:
     fid.write('\n'.join(orders))
 
 
 """
-postgres commands:
-CREATE DATABASE hermes;
-\connect hermes
-CREATE TABLE users (uid TEXT,
-                    username TEXT,
-                    email TEXT,
-                    password TEXT,
-                    created_on TIMESTAMP);
+Load the files in dependency order with the import command. Missing columns
+take their defaults and imported sites are batch geocoded afterwards:
+export FLASK_APP=hermes.py
+flask upgrade-db
+flask import-csv clients clients.csv
+flask import-csv sites sites.csv
+flask import-csv orders orders.csv
 
-CREATE TABLE clients (cid TEXT PRIMARY KEY,
-                      name TEXT,
-                      description TEXT,
-                      deleted BOOLEAN);
-\copy clients FROM 'clients.csv' WITH CSV HEADER
-
-CREATE TABLE sites (sid TEXT PRIMARY KEY,
-                    address TEXT,
-                    deleted BOOLEAN);
-\copy sites FROM 'sites.csv' WITH CSV HEADER
-
-CREATE TABLE orders (oid TEXT PRIMARY KEY,
-                     cid TEXT REFERENCES clients (cid),
-                     sid TEXT REFERENCES sites (sid),
-                     due TEXT,
-                     status TEXT,
-                     deleted BOOLEAN);
-\copy orders FROM 'orders.csv' WITH CSV HEADER
+The same files can be uploaded to /import/<entity> as the 'file' field, and
+any table can be dumped with flask export-csv or /export/<entity>.csv.
+Entities are clients, sites, parts, orders and order_lines.
 """
@@ -0,0 +1,42 @@
+# Gunicorn settings for production, read from the environment so Heroku
+# config vars can tune them without a deploy.
+#
+# WEB_WORKER_CLASS  gthread (default) or gevent. gevent needs the gevent and
+#                   psycogreen packages installed alongside requirements.txt.
+# WEB_CONCURRENCY   worker processes (default 2)
+# WEB_THREADS       threads per gthread worker (default 4)
+# WEB_CONNECTIONS   concurrent requests per gevent worker (default 100)
+#
+# Each worker has its own connection pool of DB_POOL_SIZE + DB_MAX_OVERFLOW
+# connections (see hermes.py), so keep
+#     WEB_CONCURRENCY * (DB_POOL_SIZE + DB_MAX_OVERFLOW)
+# under the database's connection limit. With gthread, DB_POOL_SIZE of
+# WEB_THREADS plus GEOCODE_WORKERS avoids threads queueing for connections.
+import os
+
+worker_class = os.environ.get('WEB_WORKER_CLASS', 'gthread')
+workers = int(os.environ.get('WEB_CONCURRENCY', 2))
+threads = int(os.environ.get('WEB_THREADS', 4))
+worker_connections = int(os.environ.get('WEB_CONNECTIONS', 100))
+bind = '0.0.0.0:{0}'.format(os.environ.get('PORT', 8000))
+timeout = 30
+accesslog = '-'
+errorlog = '-'
+# The geocoding and login worker threads start lazily inside each worker,
+# and threads don't survive a fork, so the app must not be preloaded
+preload_app = False
+
+
+def post_worker_init(worker):
+    if worker_class == 'gevent':
+        # psycopg2 blocks the whole process on queries unless it is told to
+        # yield to the gevent hub while waiting
+        from psycogreen.gevent import patch_psycopg
+        patch_psycopg()
+
+
+def on_starting(server):
+    per_worker = int(os.environ.get('DB_POOL_SIZE', 5)) + \
+        int(os.environ.get('DB_MAX_OVERFLOW', 5))
+    print('{0} {1} workers, up to {2} database connections'.format(
+        workers, worker_class, workers * per_worker))
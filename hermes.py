@@ -1,10 +1,33 @@
 import flask as fk
-from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
 import flask_login as fk_lg
 import datetime as dt
+import decimal
 import bcrypt
 import requests
+import numpy as np
 import json
+import base64
+import math
+import gzip
+import hashlib
+import csv
+import codecs
+import io
+import re
+import threading
+import queue
+import collections
+import concurrent.futures
+import functools
+import os
+import click
+import contextlib
+import time
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import DataError, IntegrityError
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.sql.expression import UpdateBase
 
 
 app = fk.Flask(__name__)
@@ -13,12 +36,153 @@ try:
 except FileNotFoundError:
     # For Heroku, use environment variables
     print('No configuration file present, trying environment variables')
-    import os
-
     app.config['ENV'] = os.environ['ENV']
     app.config['SECRET_KEY'] = os.environ['FLASK_KEY']
     app.config['SQLALCHEMY_DATABASE_URI'] = os.environ['DATABASE_URL']
-db = SQLAlchemy(app)
+    if 'REPLICA_DATABASE_URL' in os.environ:
+        app.config['SQLALCHEMY_BINDS'] = {
+            'replica': os.environ['REPLICA_DATABASE_URL']}
+    # Integer tunables that can also come from the environment
+    for key in ('DB_POOL_SIZE', 'DB_MAX_OVERFLOW', 'DB_POOL_TIMEOUT',
+                'DB_POOL_RECYCLE', 'DB_POOL_PRE_PING', 'DB_STATEMENT_TIMEOUT',
+                'PAGE_CACHE', 'REPLICA_LAG'):
+        if key in os.environ:
+            app.config[key] = int(os.environ[key])
+    # Heroku's router sits in front of the app, see client_addr()
+    app.config['PROXY_HOPS'] = int(os.environ.get('PROXY_HOPS', 1))
+    # Shared page cache backend, see PAGE_CACHE below
+    for key in ('PAGE_CACHE_TYPE', 'PAGE_CACHE_SERVERS', 'PAGE_CACHE_DIR'):
+        if key in os.environ:
+            app.config[key] = os.environ[key]
+# Tunables, override any of these in config.py
+app.config.setdefault('PAGE_SIZE', 50)
+app.config.setdefault('MAX_PAGE_SIZE', 500)
+app.config.setdefault('GEOCODER_URL',
+                      'https://geocoding.geo.census.gov/geocoder')
+app.config.setdefault('GEOCODER_TIMEOUT', 10)
+app.config.setdefault('GEOCODE_TTL', dt.timedelta(days=90))
+app.config.setdefault('GEOCODE_NEGATIVE_TTL', dt.timedelta(days=1))
+# Set GEOCODE_WORKERS to 0 to geocode inline on the request instead
+app.config.setdefault('GEOCODE_WORKERS', 2)
+app.config.setdefault('GEOCODE_MAX_ATTEMPTS', 5)
+app.config.setdefault('GEOCODE_RETRY_DELAY', 2)
+# Per-request query/latency metrics, see /admin/metrics
+app.config.setdefault('INSTRUMENT', False)
+app.config.setdefault('INSTRUMENT_SAMPLES', 1000)
+app.config.setdefault('INSTRUMENT_LOG', True)
+# Seconds a logged in user is served from memory before re-reading the DB
+app.config.setdefault('USER_CACHE_TTL', 60)
+# Password checks run on a small pool of their own, rate limited per
+# username and per client address
+app.config.setdefault('BCRYPT_ROUNDS', 12)
+app.config.setdefault('LOGIN_WORKERS', 2)
+app.config.setdefault('LOGIN_QUEUE', 8)
+app.config.setdefault('LOGIN_TIMEOUT', 10)
+app.config.setdefault('LOGIN_WINDOW', 300)
+app.config.setdefault('LOGIN_MAX_PER_USER', 5)
+app.config.setdefault('LOGIN_MAX_PER_IP', 30)
+# Proxies in front of the app that append to X-Forwarded-For
+app.config.setdefault('PROXY_HOPS', 0)
+# Change feed page size, and how far behind now() it reads so that slow
+# transactions committing older timestamps are not skipped
+app.config.setdefault('CHANGE_FEED_LIMIT', 500)
+app.config.setdefault('CHANGE_FEED_LAG', 2)
+app.config.setdefault('CHANGE_FEED_POLL', 1)
+app.config.setdefault('CHANGE_FEED_STREAM_SECONDS', 300)
+# Longest ?wait= long poll, under the 30 second Heroku router timeout
+app.config.setdefault('CHANGE_FEED_MAX_WAIT', 25)
+# Delivery routing: vehicles per day, solver time budget in seconds, and
+# the (lat, lon) every route starts and ends at. None uses the centroid of
+# the day's stops.
+app.config.setdefault('ROUTE_VEHICLES', 3)
+app.config.setdefault('ROUTE_TIME_BUDGET', 5)
+app.config.setdefault('ROUTE_DEPOT', None)
+# Due date schedule: days shown by default and the widest range allowed
+app.config.setdefault('SCHEDULE_DAYS', 7)
+app.config.setdefault('SCHEDULE_MAX_DAYS', 62)
+# Site spatial index: grid cell size in degrees, how often (seconds) to
+# pull site changes from the database, how often to rebuild outright and
+# the largest radius_km the near endpoint accepts
+app.config.setdefault('SITE_INDEX_CELL', 0.05)
+app.config.setdefault('SITE_INDEX_REFRESH', 5)
+app.config.setdefault('SITE_INDEX_REBUILD', 600)
+app.config.setdefault('SITE_INDEX_MAX_KM', 1000)
+# Part search index, same refresh/rebuild scheme, and the default number of
+# matches returned to the order form
+app.config.setdefault('PART_INDEX_REFRESH', 5)
+app.config.setdefault('PART_INDEX_REBUILD', 600)
+app.config.setdefault('PART_SEARCH_LIMIT', 20)
+# Report rollups are brought up to date at most every REPORT_REFRESH
+# seconds when a report is viewed, or by `flask refresh-reports`
+app.config.setdefault('REPORT_REFRESH', 60)
+# Rendered page cache. PAGE_CACHE_TYPE is 'lru' (per process) or one of
+# 'memcached', 'redis' or 'filesystem' to share pages between workers, with
+# PAGE_CACHE_SERVERS (comma separated) / PAGE_CACHE_DIR saying where.
+# Entries also expire after PAGE_CACHE_TTL seconds. An 'lru' cache only
+# sees writes made by its own process, so with several workers it would
+# serve stale pages; the cache is therefore off unless a shared backend is
+# configured. Set PAGE_CACHE explicitly to run 'lru' in a single process.
+app.config.setdefault('PAGE_CACHE_TYPE', 'lru')
+app.config.setdefault('PAGE_CACHE', app.config['PAGE_CACHE_TYPE'] != 'lru')
+app.config.setdefault('PAGE_CACHE_SIZE', 500)
+app.config.setdefault('PAGE_CACHE_TTL', 300)
+app.config.setdefault('PAGE_CACHE_SERVERS', None)
+app.config.setdefault('PAGE_CACHE_DIR', None)
+# Connection pool for server databases (SQLite keeps Flask-SQLAlchemy's
+# defaults). Each process holds up to DB_POOL_SIZE + DB_MAX_OVERFLOW
+# connections; size the pool to the worker's threads plus GEOCODE_WORKERS.
+# Connections idle longer than DB_POOL_RECYCLE seconds are replaced, and
+# DB_POOL_PRE_PING checks each one on checkout so connections the database
+# dropped are not handed to a request. DB_STATEMENT_TIMEOUT (ms, Postgres)
+# stops one slow query from holding a connection indefinitely.
+app.config.setdefault('DB_POOL_SIZE', 5)
+app.config.setdefault('DB_MAX_OVERFLOW', 5)
+app.config.setdefault('DB_POOL_TIMEOUT', 10)
+app.config.setdefault('DB_POOL_RECYCLE', 240)
+app.config.setdefault('DB_POOL_PRE_PING', True)
+app.config.setdefault('DB_STATEMENT_TIMEOUT', 30000)
+# Read replica, configured as the 'replica' bind (REPLICA_DATABASE_URL on
+# Heroku). Views marked with replica_reads query it on GET. REPLICA_LAG is
+# the replication delay (seconds) to allow for: a user who has just saved
+# reads from the primary for that long.
+app.config.setdefault('SQLALCHEMY_BINDS', None)
+app.config.setdefault('REPLICA_LAG', 10)
+
+
+class RoutingSession(SignallingSession):
+    # Sends reads to the replica when the current request allows it.
+    # Flushes and Core INSERT/UPDATE/DELETE always go to the primary.
+
+    def get_bind(self, mapper=None, clause=None):
+        if not self._flushing and \
+                not isinstance(clause, UpdateBase) and \
+                reads_from_replica():
+            fk.g.used_replica = True
+            return db.get_engine(self.app, bind='replica')
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+
+class PooledSQLAlchemy(SQLAlchemy):
+
+    def create_session(self, options):
+        return sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def apply_driver_hacks(self, app, info, options):
+        super(PooledSQLAlchemy, self).apply_driver_hacks(app, info, options)
+        if info.drivername.startswith('sqlite'):
+            return
+        options['pool_size'] = app.config['DB_POOL_SIZE']
+        options['max_overflow'] = app.config['DB_MAX_OVERFLOW']
+        options['pool_timeout'] = app.config['DB_POOL_TIMEOUT']
+        options['pool_recycle'] = app.config['DB_POOL_RECYCLE']
+        options['pool_pre_ping'] = bool(app.config['DB_POOL_PRE_PING'])
+        timeout = app.config['DB_STATEMENT_TIMEOUT']
+        if timeout and info.drivername.startswith('postgres'):
+            options.setdefault('connect_args', {})['options'] = \
+                '-c statement_timeout={0}'.format(int(timeout))
+
+
+db = PooledSQLAlchemy(app)
 log_man = fk_lg.LoginManager(app)
 log_man.login_view = 'login'
 
@@ -28,7 +192,7 @@ log_man.login_view = 'login'
 class User(fk_lg.UserMixin, db.Model):
     __tablename__ = 'users'
     uid = db.Column(db.Integer, primary_key=True)
-    username = db.Column(db.String(128))
+    username = db.Column(db.String(128), index=True)
     email = db.Column(db.String(128))
     password = db.Column(db.Binary(60), nullable=False)
     time_created = db.Column(db.DateTime(timezone=True),
@@ -40,7 +204,10 @@ class User(fk_lg.UserMixin, db.Model):
         return self.uid
 
     def set_pw(self, pw):
-        self.password = bcrypt.hashpw(pw.encode('utf8'), bcrypt.gensalt())
+        self.password = bcrypt.hashpw(
+            pw.encode('utf8'),
+            bcrypt.gensalt(rounds=app.config['BCRYPT_ROUNDS']))
+        user_cache.invalidate(self.uid)
 
     def check_pw(self, pw):
         return bcrypt.checkpw(pw.encode('utf8'), self.password)
@@ -48,14 +215,19 @@ class User(fk_lg.UserMixin, db.Model):
 
 class Client(db.Model):
     __tablename__ = 'clients'
+    # One index per list sort, ending in the key paginate() breaks ties on
+    __table_args__ = (db.Index('ix_clients_deleted_cid', 'deleted', 'cid'),
+                      db.Index('ix_clients_deleted_name',
+                               'deleted', 'name', 'cid'))
     cid = db.Column(db.Integer, primary_key=True)
-    order = db.relationship('Order')
+    order = db.relationship('Order', backref='client')
     name = db.Column(db.String(128))
     description = db.Column(db.String(128))
     deleted = db.Column(db.Boolean)
     time_created = db.Column(db.DateTime(timezone=True),
                              server_default=db.func.now())
-    time_modified = db.Column(db.DateTime(timezone=True),
+    time_modified = db.Column(db.DateTime(timezone=True), index=True,
+                              default=db.func.now(),
                               onupdate=db.func.now())
 
     def __repr__(self):
@@ -68,15 +240,21 @@ class Client(db.Model):
 
 class Site(db.Model):
     __tablename__ = 'sites'
+    __table_args__ = (db.Index('ix_sites_deleted_sid', 'deleted', 'sid'),
+                      db.Index('ix_sites_deleted_address',
+                               'deleted', 'address', 'sid'))
     sid = db.Column(db.Integer, primary_key=True)
-    order = db.relationship('Order')
+    order = db.relationship('Order', backref='site')
     address = db.Column(db.String(128))
-    lat = db.Column(db.Numeric(precision=5))
-    lon = db.Column(db.Numeric(precision=5))
+    lat = db.Column(db.Numeric(9, 6))
+    lon = db.Column(db.Numeric(9, 6))
+    # One of 'pending', 'done' or 'failed', see GeocodeQueue
+    geocode_status = db.Column(db.String(32))
     deleted = db.Column(db.Boolean)
     time_created = db.Column(db.DateTime(timezone=True),
                              server_default=db.func.now())
-    time_modified = db.Column(db.DateTime(timezone=True),
+    time_modified = db.Column(db.DateTime(timezone=True), index=True,
+                              default=db.func.now(),
                               onupdate=db.func.now())
 
     def __repr__(self):
@@ -84,21 +262,28 @@ class Site(db.Model):
 
     def to_dict(self):
         return {'sid': self.sid, 'address': self.address,
+                'geocode_status': self.geocode_status,
                 'deleted': self.deleted}
 
 
 class Order(db.Model):
     __tablename__ = 'orders'
+    __table_args__ = (db.Index('ix_orders_deleted_oid', 'deleted', 'oid'),
+                      db.Index('ix_orders_deleted_status_oid',
+                               'deleted', 'status', 'oid'),
+                      db.Index('ix_orders_deleted_due_oid',
+                               'deleted', 'due', 'oid'))
     oid = db.Column(db.Integer, primary_key=True)
     cid = db.Column(db.Integer, db.ForeignKey('clients.cid'))
     sid = db.Column(db.Integer, db.ForeignKey('sites.sid'))
-    due = db.Column(db.String(128))
+    due = db.Column(db.Date)
     status = db.Column(db.String(128))
     deleted = db.Column(db.Boolean)
     order_to_part = db.relationship('OrderToPart')
     time_created = db.Column(db.DateTime(timezone=True),
                              server_default=db.func.now())
-    time_modified = db.Column(db.DateTime(timezone=True),
+    time_modified = db.Column(db.DateTime(timezone=True), index=True,
+                              default=db.func.now(),
                               onupdate=db.func.now())
 
     def __repr__(self):
@@ -109,29 +294,36 @@ class Order(db.Model):
                                                   self.status)
 
     def to_dict(self):
-        c = ''
-        s = ''
-        if Client.query.get(self.cid):
-            c = Client.query.filter_by(cid=self.cid).first().name
-        if Site.query.get(self.sid):
-            s = Site.query.filter_by(sid=self.sid).first().address
+        # Use order_query() for listings so client and site are eager loaded
+        c = self.client.name if self.client else ''
+        s = self.site.address if self.site else ''
         return {'oid': self.oid, 'cid': self.cid, 'client': c,
-                'sid': self.sid, 'site': s, 'due': self.due,
+                'sid': self.sid, 'site': s,
+                'due': str(self.due) if self.due else None,
                 'status': self.status, 'deleted': self.deleted}
 
 
 class Part(db.Model):
     __tablename__ = 'parts'
+    __table_args__ = (db.Index('ix_parts_deleted_pid', 'deleted', 'pid'),
+                      db.Index('ix_parts_deleted_name',
+                               'deleted', 'name', 'pid'),
+                      db.Index('ix_parts_deleted_units',
+                               'deleted', 'units', 'pid'))
     pid = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(128))
     description = db.Column(db.String(128))
     units = db.Column(db.String(128))
     stock = db.Column(db.Integer)
+    # Sum of live order line quantities, kept current by adjust_reserved()
+    reserved = db.Column(db.Integer, nullable=False, default=0,
+                         server_default='0')
     deleted = db.Column(db.Boolean)
     order_to_part = db.relationship('OrderToPart')
     time_created = db.Column(db.DateTime(timezone=True),
                              server_default=db.func.now())
-    time_modified = db.Column(db.DateTime(timezone=True),
+    time_modified = db.Column(db.DateTime(timezone=True), index=True,
+                              default=db.func.now(),
                               onupdate=db.func.now())
 
     def __repr__(self):
@@ -140,11 +332,18 @@ class Part(db.Model):
     def to_dict(self):
         return {'pid': self.pid, 'name': self.name,
                 'description': self.description, 'units': self.units,
-                'stock': self.stock, 'deleted': self.deleted}
+                'stock': self.stock, 'reserved': self.reserved,
+                'deleted': self.deleted}
 
 
 class OrderToPart(db.Model):
     __tablename__ = 'order_to_part'
+    __table_args__ = (db.Index('ix_order_to_part_deleted_otpid',
+                               'deleted', 'otpid'),
+                      db.Index('ix_order_to_part_deleted_pid_otpid',
+                               'deleted', 'pid', 'otpid'),
+                      db.Index('ix_order_to_part_deleted_oid_pid',
+                               'deleted', 'oid', 'pid'))
     otpid = db.Column(db.Integer, primary_key=True)
     oid = db.Column(db.Integer, db.ForeignKey('orders.oid'))
     pid = db.Column(db.Integer, db.ForeignKey('parts.pid'))
@@ -153,7 +352,8 @@ class OrderToPart(db.Model):
     deleted = db.Column(db.Boolean)
     time_created = db.Column(db.DateTime(timezone=True),
                              server_default=db.func.now())
-    time_modified = db.Column(db.DateTime(timezone=True),
+    time_modified = db.Column(db.DateTime(timezone=True), index=True,
+                              default=db.func.now(),
                               onupdate=db.func.now())
 
     def __repr__(self):
@@ -162,6 +362,368 @@ class OrderToPart(db.Model):
                                                   self.pid,
                                                   self.quantity,
                                                   self.price)
+
+    def to_dict(self):
+        return {'otpid': self.otpid, 'oid': self.oid, 'pid': self.pid,
+                'quantity': self.quantity,
+                'price': float(self.price) if self.price is not None
+                else None,
+                'deleted': self.deleted}
+
+
+class GeocodeCache(db.Model):
+    __tablename__ = 'geocode_cache'
+    address = db.Column(db.String(256), primary_key=True)
+    # NULL coordinates record an address the geocoder could not match
+    lat = db.Column(db.Numeric(9, 6))
+    lon = db.Column(db.Numeric(9, 6))
+    time_checked = db.Column(db.DateTime)
+    time_created = db.Column(db.DateTime(timezone=True),
+                             server_default=db.func.now())
+    time_modified = db.Column(db.DateTime(timezone=True),
+                              onupdate=db.func.now())
+
+    def __repr__(self):
+        return '<{0}, {1}, {2}>'.format(self.address, self.lat, self.lon)
+
+    def is_fresh(self, now):
+        if self.lat is None:
+            ttl = app.config['GEOCODE_NEGATIVE_TTL']
+        else:
+            ttl = app.config['GEOCODE_TTL']
+        return self.time_checked is not None and self.time_checked + ttl > now
+
+
+class ReportLine(db.Model):
+    # What each order line last contributed to report_rollup, so a refresh
+    # can take the old contribution back out when the line or order changes
+    __tablename__ = 'report_lines'
+    otpid = db.Column(db.Integer, primary_key=True)
+    oid = db.Column(db.Integer, index=True)
+    day = db.Column(db.Date)
+    cid = db.Column(db.Integer)
+    sid = db.Column(db.Integer)
+    pid = db.Column(db.Integer)
+    status = db.Column(db.String(128))
+    quantity = db.Column(db.Integer)
+    revenue = db.Column(db.Numeric(14, 2))
+
+
+class ReportRollup(db.Model):
+    # Order line totals by grain (day/week/month), period start, dimension
+    # (client/site/part/all), the member's ID within it and order status
+    __tablename__ = 'report_rollup'
+    grain = db.Column(db.String(8), primary_key=True)
+    dimension = db.Column(db.String(8), primary_key=True)
+    period = db.Column(db.Date, primary_key=True)
+    member = db.Column(db.Integer, primary_key=True)
+    status = db.Column(db.String(128), primary_key=True)
+    quantity = db.Column(db.Integer, nullable=False)
+    revenue = db.Column(db.Numeric(14, 2), nullable=False)
+    lines = db.Column(db.Integer, nullable=False)
+
+
+class ReportState(db.Model):
+    # Where the last rollup refresh got to in time_modified
+    __tablename__ = 'report_state'
+    name = db.Column(db.String(32), primary_key=True)
+    watermark = db.Column(db.DateTime)
+
+
+# Indexes replaced by ones ending in the key, dropped by upgrade_db()
+RETIRED_INDEXES = {'orders': ['ix_orders_deleted_status',
+                              'ix_orders_deleted_due'],
+                   'order_to_part': ['ix_order_to_part_deleted_pid']}
+
+# Entities by their URL/command name, and the columns each list can sort by.
+# Their time_modified is set on insert too, so the change feed can page on
+# it alone.
+ENTITIES = {'clients': Client, 'sites': Site, 'parts': Part,
+            'orders': Order, 'order_lines': OrderToPart}
+SORT_COLUMNS = {Client: {'name': Client.name},
+                Site: {'address': Site.address},
+                Part: {'name': Part.name, 'units': Part.units},
+                Order: {'due': Order.due, 'status': Order.status},
+                OrderToPart: {'oid': OrderToPart.oid,
+                              'pid': OrderToPart.pid}}
+
+
+class CachedUser(fk_lg.UserMixin):
+    # The parts of a User the views need, safe to share across requests
+    # and threads without a session attached
+
+    def __init__(self, user):
+        self.uid = user.uid
+        self.username = user.username
+        self.email = user.email
+
+    def get_id(self):
+        return self.uid
+
+
+class UserCache(object):
+    # Per-process cache behind load_user(). Entries expire after
+    # USER_CACHE_TTL seconds and are dropped whenever the user row changes.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.users = {}
+
+    def get(self, uid):
+        try:
+            uid = int(uid)
+        except (TypeError, ValueError):
+            return None
+        now = time.time()
+        with self.lock:
+            hit = self.users.get(uid)
+        if hit is not None and hit[0] > now:
+            return hit[1]
+        user = User.query.get(uid)
+        if user is None:
+            self.invalidate(uid)
+            return None
+        cached = CachedUser(user)
+        with self.lock:
+            self.users[uid] = (now + app.config['USER_CACHE_TTL'], cached)
+        return cached
+
+    def invalidate(self, uid=None):
+        with self.lock:
+            if uid is None:
+                self.users.clear()
+            else:
+                self.users.pop(uid, None)
+
+
+user_cache = UserCache()
+
+
+@db.event.listens_for(User, 'after_update')
+@db.event.listens_for(User, 'after_delete')
+def invalidate_cached_user(mapper, connection, target):
+    user_cache.invalidate(target.uid)
+###############################################################################
+
+# Page Cache ##################################################################
+
+
+class LRUCache(object):
+    # In-process stand-in for the werkzeug cache backends, evicting the
+    # least recently used entry once `size` entries are held. A timeout of
+    # 0 never expires.
+
+    def __init__(self, size, default_timeout):
+        self.lock = threading.Lock()
+        self.size = size
+        self.default_timeout = default_timeout
+        self.entries = collections.OrderedDict()
+
+    def get(self, key):
+        with self.lock:
+            hit = self.entries.get(key)
+            if hit is None:
+                return None
+            if hit[0] and hit[0] < time.time():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return hit[1]
+
+    def get_many(self, *keys):
+        return [self.get(k) for k in keys]
+
+    def set(self, key, value, timeout=None):
+        if timeout is None:
+            timeout = self.default_timeout
+        expires = time.time() + timeout if timeout else 0
+        with self.lock:
+            self.entries[key] = (expires, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        return True
+
+    def add(self, key, value, timeout=None):
+        if self.get(key) is not None:
+            return False
+        return self.set(key, value, timeout)
+
+    def delete(self, key):
+        with self.lock:
+            return self.entries.pop(key, None) is not None
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+        return True
+
+
+def make_page_cache():
+    kind = app.config['PAGE_CACHE_TYPE']
+    ttl = app.config['PAGE_CACHE_TTL']
+    if kind == 'lru':
+        return LRUCache(app.config['PAGE_CACHE_SIZE'], ttl)
+    from werkzeug.contrib import cache
+    servers = app.config['PAGE_CACHE_SERVERS']
+    if isinstance(servers, str):
+        servers = [server.strip() for server in servers.split(',')]
+    if kind == 'memcached':
+        return cache.MemcachedCache(servers,
+                                    default_timeout=ttl,
+                                    key_prefix='hermes-page:')
+    if kind == 'redis':
+        host, _, port = (servers[0] if servers else
+                         'localhost').partition(':')
+        return cache.RedisCache(host, int(port or 6379), default_timeout=ttl,
+                                key_prefix='hermes-page:')
+    if kind == 'filesystem':
+        return cache.FileSystemCache(app.config['PAGE_CACHE_DIR'],
+                                     threshold=app.config['PAGE_CACHE_SIZE'],
+                                     default_timeout=ttl)
+    raise ValueError('Unknown PAGE_CACHE_TYPE {0}'.format(kind))
+
+
+page_cache = make_page_cache()
+
+
+def table_generations(tables):
+    # Every table has a generation token in the cache, replaced whenever a
+    # write to it commits. Pages are stored under the tokens they were
+    # rendered with, so a write strands the old pages rather than having
+    # to find and delete them.
+    keys = ['gen:' + t for t in tables]
+    gens = page_cache.get_many(*keys)
+    for i, gen in enumerate(gens):
+        if gen is None:
+            gen = new_generation()
+            page_cache.add(keys[i], gen, timeout=0)
+            gens[i] = page_cache.get(keys[i]) or gen
+    return gens
+
+
+def new_generation():
+    # <time>-<random>, the time lets readers tell how recent a write is
+    return '{0:.3f}-{1}'.format(time.time(),
+                                base64.b64encode(os.urandom(9)).decode())
+
+
+def generation_time(gen):
+    try:
+        return float(gen.split('-', 1)[0])
+    except ValueError:
+        return 0
+
+
+def tables_changed(tables):
+    for table in tables:
+        page_cache.set('gen:' + table, new_generation(), timeout=0)
+
+
+def cached_page(*models):
+    # Serve a rendered view from page_cache, keyed on the full path and the
+    # generations of the tables it reads. Goes under login_required.
+    tables = sorted(m.__tablename__ for m in models)
+
+    def decorate(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if not app.config['PAGE_CACHE']:
+                return view(*args, **kwargs)
+            gens = table_generations(tables)
+            key = 'page:{0}:{1}'.format(fk.request.full_path, ':'.join(gens))
+            page = page_cache.get(key)
+            if page is None:
+                page = view(*args, **kwargs)
+                if replica_caught_up(gens):
+                    page_cache.set(key, page)
+            return page
+        return wrapper
+    return decorate
+
+
+# Writes are noted per connection as they execute, whichever path issued
+# them (ORM flush, bulk mappings, Core executemany), handed to the thread on
+# commit and published once the session commit has finished. Publishing
+# before then would let a reader cache old rows under the new generation.
+committed_writes = threading.local()
+
+
+@db.event.listens_for(Engine, 'after_cursor_execute')
+def note_written_table(conn, cursor, statement, parameters, context,
+                       executemany):
+    if context is None or context.compiled is None:
+        return
+    if context.isinsert or context.isupdate or context.isdelete:
+        table = getattr(context.compiled.statement, 'table', None)
+        if table is not None:
+            conn.info.setdefault('written', set()).add(table.name)
+
+
+@db.event.listens_for(Engine, 'commit')
+def hand_over_writes(conn):
+    written = conn.info.pop('written', None)
+    if written:
+        pending = getattr(committed_writes, 'tables', set())
+        committed_writes.tables = pending | written
+
+
+@db.event.listens_for(Engine, 'rollback')
+def forget_writes(conn):
+    conn.info.pop('written', None)
+
+
+@db.event.listens_for(db.session, 'after_commit')
+def publish_writes(session):
+    pending = getattr(committed_writes, 'tables', None)
+    if pending:
+        committed_writes.tables = set()
+        tables_changed(pending)
+###############################################################################
+
+# Read Replica ################################################################
+
+
+def replica_reads(view):
+    # GETs of this view may read from the replica. Goes under cached_page.
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if fk.request.method == 'GET':
+            fk.g.replica = True
+        return view(*args, **kwargs)
+    return wrapper
+
+
+def replica_enabled():
+    return 'replica' in (app.config['SQLALCHEMY_BINDS'] or {})
+
+
+def reads_from_replica():
+    if not fk.has_request_context() or not fk.g.get('replica') or \
+            not replica_enabled():
+        return False
+    # Read your writes: stay on the primary for a while after saving
+    return fk.session.get('primary_until', 0) < time.time()
+
+
+def replica_caught_up(gens):
+    # A page read from the replica may be behind the generations it would
+    # be cached under, until REPLICA_LAG has passed since the last write
+    if not fk.g.get('used_replica'):
+        return True
+    newest = max([generation_time(g) for g in gens] or [0])
+    return time.time() - newest > app.config['REPLICA_LAG']
+
+
+@db.event.listens_for(Engine, 'after_cursor_execute')
+def stick_to_primary(conn, cursor, statement, parameters, context,
+                     executemany):
+    if context is None or not (context.isinsert or context.isupdate or
+                               context.isdelete):
+        return
+    if fk.has_request_context() and replica_enabled():
+        fk.session['primary_until'] = time.time() + \
+            app.config['REPLICA_LAG']
 ###############################################################################
 
 # Routes ######################################################################
@@ -170,32 +732,29 @@ class OrderToPart(db.Model):
 @app.route('/')
 @app.route('/index/')
 @fk_lg.login_required
+@cached_page(Order, OrderToPart, Part)
+@replica_reads
 def index():
-    order_types = {'placed': len(Order.query.filter_by(deleted=False,
-                                                       status='Order placed').all()),
-                   'scheduled': len(Order.query.filter_by(deleted=False,
-                                                          status='Delivery scheduled').all()),
-                   'dispatched': len(Order.query.filter_by(deleted=False,
-                                                           status='Driver dispatched').all()),
-                   'completed': len(Order.query.filter_by(deleted=False,
-                                                          status='Order completed').all())}
-    restock = []
-    for part in Part.query.filter_by(deleted=False).all():
-        q = sum([o.quantity
-                 for o in OrderToPart.query.filter_by(deleted=False,
-                                                      pid=part.pid).all()])
-        curr = part.stock
-        if q > curr:
-            restock.append({'name': part.name, 'number': q - curr})
-    # restock = [{'name': 'Part A', 'number': 2},
-    #            {'name': 'Part B', 'number': 4}]
-    return fk.render_template('index.html', summary=order_types,
-                              restock=restock)
+    return fk.render_template('index.html', summary=get_order_summary(),
+                              restock=get_restock())
 
 
 @log_man.user_loader
 def load_user(uid):
-    return User.query.get(uid)
+    return user_cache.get(uid)
+
+
+def client_addr():
+    # Each trusted proxy appends the address it saw to X-Forwarded-For, so
+    # the client is PROXY_HOPS entries from the end. Entries before that
+    # come from the client and can be forged.
+    hops = app.config['PROXY_HOPS']
+    forwarded = [a.strip() for a in
+                 fk.request.headers.get('X-Forwarded-For', '').split(',')
+                 if a.strip()]
+    if hops and len(forwarded) >= hops:
+        return forwarded[-hops]
+    return fk.request.remote_addr
 
 
 @app.route('/login', methods=['GET', 'POST'])
@@ -203,9 +762,33 @@ def login():
     if fk_lg.current_user.is_authenticated:
         return fk.redirect(fk.url_for('index'))
     if fk.request.method == 'POST':
-        u = User.query.filter_by(username=fk.request.form['username']).first()
-        if not u or not u.check_pw(fk.request.form['password']):
+        username = fk.request.form['username']
+        addr = client_addr()
+        limited = [('ip', addr), ('user', username)]
+        if not login_limiter.allow(limited):
+            return fk.render_template('login.html', username=username,
+                                      error='Too many attempts, try again '
+                                            'later'), 429
+        # Every attempt counts against the address, failures against the
+        # username as well
+        login_limiter.hit([('ip', addr)])
+        u = User.query.filter_by(username=username).first()
+        if not u:
+            login_limiter.hit([('user', username)])
+            return fk.redirect(fk.url_for('login'))
+        try:
+            ok, upgraded = login_pool.verify(u.password,
+                                             fk.request.form['password'])
+        except LoginBusy:
+            return fk.render_template('login.html', username=username,
+                                      error='Server busy, try again'), 503
+        if not ok:
+            login_limiter.hit([('user', username)])
             return fk.redirect(fk.url_for('login'))
+        if upgraded:
+            u.password = upgraded
+            db.session.commit()
+        login_limiter.reset([('user', username)])
         fk_lg.login_user(u)
         return fk.redirect(fk.url_for('index'))
     return fk.render_template('login.html')
@@ -219,37 +802,37 @@ def logout():
 
 @app.route('/clients/')
 @fk_lg.login_required
+@cached_page(Client)
+@replica_reads
 def clients():
-    res = [c.to_dict() for c in Client.query.filter_by(deleted=False).all()]
-    return fk.render_template('clients.html', clients=res)
+    rows, page = paginate(Client.query.filter_by(deleted=False), Client.cid,
+                          SORT_COLUMNS[Client])
+    return fk.render_template('clients.html',
+                              clients=[c.to_dict() for c in rows], page=page)
 
 
 @app.route('/client/<cid>', methods=['GET', 'POST'])
 @fk_lg.login_required
+@replica_reads
 def client(cid):
     if fk.request.method == 'GET':
         if cid == 'new':
-            # Get the max ID in the database
-            max_cid = Client.query.order_by(Client.cid.desc()).first().cid
-            res = Client(cid=max_cid + 1,
-                         name='',
+            # The database assigns the CID when the form is saved
+            res = Client(name='',
                          description='',
                          deleted=False).to_dict()
         else:
-            res = Client.query.get(cid).to_dict()
+            res = Client.query.get_or_404(cid).to_dict()
         return fk.render_template('client.html', client=res)
     else:
-        id_val = int(fk.request.form['cid'])
         new_name = fk.request.form['name']
         new_description = fk.request.form['description']
-        # If CID is already in the database, update record, o.w. create new
-        existing = Client.query.get(id_val)
-        if existing is not None:
+        if cid != 'new':
+            existing = Client.query.get_or_404(cid)
             existing.name = new_name
             existing.description = new_description
         else:
-            new_client = Client(cid=id_val,
-                                name=new_name,
+            new_client = Client(name=new_name,
                                 description=new_description,
                                 deleted=False)
             db.session.add(new_client)
@@ -260,225 +843,193 @@ def client(cid):
 @app.route('/delete_clients/', methods=['POST'])
 @fk_lg.login_required
 def delete_clients():
-    ids_to_delete = [int(k.split('_')[1]) for k in fk.request.form.keys()]
-    for c in Client.query.filter(Client.cid.in_(ids_to_delete)).all():
-        c.deleted = True
+    soft_delete(Client, ids=checked_ids(fk.request.form))
     db.session.commit()
     return fk.redirect(fk.url_for('clients'))
 
 
 @app.route('/sites/')
 @fk_lg.login_required
+@cached_page(Site)
+@replica_reads
 def sites():
-    res = [s.to_dict() for s in Site.query.filter_by(deleted=False).all()]
-    return fk.render_template('sites.html', sites=res)
+    rows, page = paginate(Site.query.filter_by(deleted=False), Site.sid,
+                          SORT_COLUMNS[Site])
+    return fk.render_template('sites.html',
+                              sites=[s.to_dict() for s in rows], page=page)
 
 
 @app.route('/site/<sid>', methods=['GET', 'POST'])
 @fk_lg.login_required
+@replica_reads
 def site(sid):
     if fk.request.method == 'GET':
         if sid == 'new':
-            # Get the max ID in the database
-            max_sid = Site.query.order_by(Site.sid.desc()).first().sid
-            res = Site(sid=max_sid + 1,
-                       address='',
-                       lat=0,
-                       lon=0,
+            # The database assigns the SID when the form is saved
+            res = Site(address='',
                        deleted=False).to_dict()
         else:
-            res = Site.query.get(sid).to_dict()
+            res = Site.query.get_or_404(sid).to_dict()
         return fk.render_template('site.html', site=res)
     else:
-        id_val = int(fk.request.form['sid'])
         new_address = fk.request.form['address']
-        # If SID is already in the database, update record, o.w. create new
-        existing = Site.query.get(id_val)
-        if existing is not None:
+        if sid != 'new':
+            existing = Site.query.get_or_404(sid)
+            moved = existing.address != new_address
             existing.address = new_address
         else:
-            lat, lon = get_lat_lon(new_address)
-            new_site = Site(sid=id_val,
-                            address=new_address,
-                            lat=lat,
-                            lon=lon,
+            moved = True
+            existing = Site(address=new_address,
                             deleted=False)
-            db.session.add(new_site)
+            db.session.add(existing)
+        # Coordinates are filled in by the geocode queue after the commit
+        if moved:
+            existing.lat = None
+            existing.lon = None
+            existing.geocode_status = 'pending'
         db.session.commit()
+        if moved:
+            geocode_queue.submit(existing.sid)
         return fk.redirect(fk.url_for('sites'))
 
 
 @app.route('/delete_sites/', methods=['POST'])
 @fk_lg.login_required
 def delete_sites():
-    ids_to_delete = [int(k.split('_')[1]) for k in fk.request.form.keys()]
-    for s in Site.query.filter(Site.sid.in_(ids_to_delete)).all():
-        s.deleted = True
+    soft_delete(Site, ids=checked_ids(fk.request.form))
     db.session.commit()
     return fk.redirect(fk.url_for('sites'))
 
 
 @app.route('/parts/')
 @fk_lg.login_required
+@cached_page(Part)
+@replica_reads
 def parts():
-    res = [p.to_dict() for p in Part.query.filter_by(deleted=False).all()]
-    return fk.render_template('parts.html', parts=res)
+    rows, page = paginate(Part.query.filter_by(deleted=False), Part.pid,
+                          SORT_COLUMNS[Part])
+    return fk.render_template('parts.html',
+                              parts=[p.to_dict() for p in rows], page=page)
 
 
 @app.route('/part/<pid>', methods=['GET', 'POST'])
 @fk_lg.login_required
+@replica_reads
 def part(pid):
     if fk.request.method == 'GET':
         if pid == 'new':
-            # Get the max ID in the database
-            max_pid = Part.query.order_by(Part.pid.desc()).first().pid
-            res = Part(pid=max_pid + 1,
-                       name='',
+            # The database assigns the PID when the form is saved
+            res = Part(name='',
                        description='',
                        units='',
                        stock=0,
                        deleted=False).to_dict()
         else:
-            res = Part.query.get(pid).to_dict()
+            res = Part.query.get_or_404(pid).to_dict()
         return fk.render_template('part.html', part=res)
     else:
-        id_val = int(fk.request.form['pid'])
         new_name = fk.request.form['name']
         new_description = fk.request.form['description']
         new_units = fk.request.form['units']
         new_stock = fk.request.form['stock']
-        # If PID is already in the database, update record, o.w. create new
-        existing = Part.query.get(id_val)
-        if existing is not None:
+        if pid != 'new':
+            existing = Part.query.get_or_404(pid)
             existing.name = new_name
             existing.description = new_description
             existing.units = new_units
             existing.stock = new_stock
         else:
-            new_part = Part(pid=id_val,
-                            name=new_name,
+            new_part = Part(name=new_name,
                             description=new_description,
                             units=new_units,
                             stock=new_stock,
                             deleted=False)
             db.session.add(new_part)
         db.session.commit()
+        # Let this worker's part search see the edit straight away
+        part_index.sync(force=True)
         return fk.redirect(fk.url_for('parts'))
 
 
 @app.route('/delete_parts/', methods=['POST'])
 @fk_lg.login_required
 def delete_parts():
-    ids_to_delete = [int(k.split('_')[1]) for k in fk.request.form.keys()]
-    for p in Part.query.filter(Part.pid.in_(ids_to_delete)).all():
-        p.deleted = True
+    soft_delete(Part, ids=checked_ids(fk.request.form))
     db.session.commit()
     return fk.redirect(fk.url_for('parts'))
 
 
 @app.route('/orders/')
 @fk_lg.login_required
+@cached_page(Order, Client, Site)
+@replica_reads
 def orders():
-    res = [o.to_dict() for o in Order.query.filter_by(deleted=False).all()]
-    return fk.render_template('orders.html', orders=res)
+    rows, page = paginate(order_query(), Order.oid, SORT_COLUMNS[Order])
+    return fk.render_template('orders.html',
+                              orders=[o.to_dict() for o in rows], page=page)
 
 
 @app.route('/order/<oid>', methods=['GET', 'POST'])
 @fk_lg.login_required
+@replica_reads
 def order(oid):
     if fk.request.method == 'GET':
+        c_opts = [{'cid': c.cid, 'name': c.name}
+                  for c in Client.query.filter_by(deleted=False)
+                  .order_by(Client.cid).all()]
+        s_opts = [{'sid': s.sid, 'address': s.address}
+                  for s in Site.query.filter_by(deleted=False)
+                  .order_by(Site.sid).all()]
         if oid == 'new':
-            # Get the max ID in the database
-            latest = Order.query.order_by(Order.oid.desc()).first()
-            if latest:
-                max_oid = latest.oid
-            else:
-                max_oid = 0
-            # Set default CID and SID to most recent, max values
-            latest = Client.query.order_by(Client.cid.desc()).first()
-            if latest:
-                max_cid = latest.cid
-            else:
-                max_cid = 0
-            latest = Site.query.order_by(Site.sid.desc()).first()
-            if latest:
-                max_sid = latest.sid
-            else:
-                max_sid = 0
-            res = Order(oid=max_oid + 1,
-                        cid=max_cid,
-                        sid=max_sid,
-                        due=str(dt.datetime.utcnow()).split()[0],
+            # The database assigns the OID when the form is saved. Default
+            # the client and site to the most recently added ones.
+            res = Order(cid=c_opts[-1]['cid'] if c_opts else None,
+                        sid=s_opts[-1]['sid'] if s_opts else None,
+                        due=dt.datetime.utcnow().date(),
                         status='Order placed',
                         deleted=False).to_dict()
+            lines = {}
         else:
-            res = Order.query.get(oid).to_dict()
-        c_opts = [{'cid': c.cid, 'name': c.name}
-                  for c in Client.query.filter_by(deleted=False).all()]
-        s_opts = [{'sid': s.sid, 'address': s.address}
-                  for s in Site.query.filter_by(deleted=False).all()]
-        # Loop twice here, the first time to allocate blank values
-        # TODO: This is certainly inefficient, improve it somehow
-        p_opts = [{'pid': p.pid, 'name': p.name, 'stock': p.stock,
-                   'current': 0, 'price': 0.00}
-                  for p in Part.query.filter_by(deleted=False).all()]
-        for p in p_opts:
-            for otp in OrderToPart.query.filter_by(deleted=False,
-                                                   pid=p['pid'],
-                                                   oid=res['oid']).all():
-                p['current'] = otp.quantity
-                p['price'] = otp.price
+            res = Order.query.get_or_404(oid).to_dict()
+            lines = get_order_lines(res['oid'])
+        # Only the parts already on the order, the rest are found through
+        # the part search
+        p_opts = []
+        if lines:
+            for p in Part.query.filter(Part.pid.in_(list(lines)),
+                                       Part.deleted == db.false()) \
+                    .order_by(Part.name).all():
+                otp = lines[p.pid]
+                p_opts.append({'pid': p.pid, 'name': p.name,
+                               'stock': p.stock,
+                               'available': (p.stock or 0) - p.reserved,
+                               'current': otp.quantity, 'price': otp.price})
         return fk.render_template('order.html', order=res,
                                   clients=c_opts, sites=s_opts, parts=p_opts)
     else:
-        oid_val = int(fk.request.form['oid'])
         new_cid = int(fk.request.form['client'])
         new_sid = int(fk.request.form['site'])
-        new_due = fk.request.form['due']
+        new_due = parse_day(fk.request.form['due'])
+        if new_due is None:
+            fk.abort(400)
         new_status = fk.request.form['status']
-        new_mapping = None
-        for p in Part.query.filter_by(deleted=False).all():
-            if OrderToPart.query.order_by(OrderToPart.otpid.desc()).first():
-                max_otpid = OrderToPart.query.order_by(
-                    OrderToPart.otpid.desc()).first().otpid
-            else:
-                max_otpid = 0
-            new_quantity = int(fk.request.form['{0}_current'.format(p.pid)])
-            new_price = float(fk.request.form['{0}_price'.format(p.pid)])
-            existing = OrderToPart.query.filter_by(deleted=False,
-                                                   pid=p.pid,
-                                                   oid=oid_val).first()
-            if existing is not None:
-                record = OrderToPart.query.get(existing.otpid)
-                record.quantity = new_quantity
-                record.price = new_price
-            elif new_quantity == 0:
-                continue
-            else:
-                new_mapping = OrderToPart(otpid=max_otpid + 1,
-                                          oid=oid_val,
-                                          pid=p.pid,
-                                          quantity=new_quantity,
-                                          price=new_price,
-                                          deleted=False)
-
-        # If OID is already in the database, update record, o.w. create new
-        existing = Order.query.get(oid_val)
-        if existing is not None:
+        if oid != 'new':
+            existing = Order.query.get_or_404(oid)
             existing.cid = new_cid
             existing.sid = new_sid
             existing.due = new_due
             existing.status = new_status
         else:
-            new_order = Order(oid=oid_val,
-                              cid=new_cid,
-                              sid=new_sid,
-                              due=new_due,
-                              status=new_status,
-                              deleted=False)
-            db.session.add(new_order)
-        if new_mapping:
-            db.session.add(new_mapping)
+            existing = Order(cid=new_cid,
+                             sid=new_sid,
+                             due=new_due,
+                             status=new_status,
+                             deleted=False)
+            db.session.add(existing)
+        # The order row (and a new OID) has to exist before its lines are
+        # bulk inserted
+        db.session.flush()
+        save_order_lines(existing.oid, parse_order_lines(fk.request.form))
         db.session.commit()
         return fk.redirect(fk.url_for('orders'))
 
@@ -486,41 +1037,496 @@ def order(oid):
 @app.route('/delete_orders/', methods=['POST'])
 @fk_lg.login_required
 def delete_orders():
-    ids_to_delete = [int(k.split('_')[1]) for k in fk.request.form.keys()]
-    for o in Order.query.filter(Order.oid.in_(ids_to_delete)).all():
-        o.deleted = True
-    for o in OrderToPart.query.filter(OrderToPart.oid.in_(ids_to_delete)).all():
-        o.deleted = True
+    soft_delete(Order, ids=checked_ids(fk.request.form))
     db.session.commit()
     return fk.redirect(fk.url_for('orders'))
+
+
+@app.route('/bulk/<entity>/<action>', methods=['POST'])
+@fk_lg.login_required
+def bulk_soft_delete(entity, action):
+    # Delete or restore by id list (ids=1,2,3) and/or by column filters,
+    # e.g. status=Order completed&due_before=2018-06-01
+    if entity not in ENTITIES or action not in ('delete', 'restore'):
+        fk.abort(404)
+    model = ENTITIES[entity]
+    args = fk.request.values.to_dict()
+    ids = None
+    if args.get('ids'):
+        try:
+            ids = [int(i) for i in args.pop('ids').split(',')]
+        except ValueError:
+            fk.abort(400)
+    args.pop('ids', None)
+    criteria = bulk_criteria(model, args)
+    if ids is None and not criteria:
+        # Refuse to touch a whole table by accident
+        fk.abort(400)
+    counts = soft_delete(model, ids=ids, criteria=criteria,
+                         deleted=action == 'delete')
+    db.session.commit()
+    return fk.jsonify(counts)
 ###############################################################################
 
 # Helper Functions ############################################################
 
 
+ORDER_STATUSES = [('placed', 'Order placed'),
+                  ('scheduled', 'Delivery scheduled'),
+                  ('dispatched', 'Driver dispatched'),
+                  ('completed', 'Order completed')]
+
+
+def get_order_summary():
+    # One GROUP BY over orders instead of a full fetch per status
+    counts = dict(db.session.query(Order.status, db.func.count(Order.oid))
+                  .filter_by(deleted=False)
+                  .group_by(Order.status)
+                  .all())
+    return {key: counts.get(status, 0) for key, status in ORDER_STATUSES}
+
+
+def get_restock():
+    # Reads the maintained Part.reserved counter, no order line scan
+    stock = db.func.coalesce(Part.stock, 0)
+    rows = db.session.query(Part.name, Part.reserved - stock) \
+        .filter(Part.deleted == False,  # noqa: E712
+                Part.reserved > stock) \
+        .order_by(Part.pid) \
+        .all()
+    return [{'name': name, 'number': number} for name, number in rows]
+
+
+def parse_day(value):
+    # Dates come in as YYYY-MM-DD, None if it isn't one
+    if isinstance(value, dt.datetime):
+        return value.date()
+    if isinstance(value, dt.date):
+        return value
+    try:
+        return dt.datetime.strptime((value or '')[:10], '%Y-%m-%d').date()
+    except ValueError:
+        return None
+
+
+def order_query(**filters):
+    # Client and site come back in the same SELECT, so the query count is
+    # fixed regardless of how many orders are listed
+    return Order.query.options(db.joinedload(Order.client),
+                               db.joinedload(Order.site)) \
+        .filter_by(deleted=False, **filters)
+
+
+def get_order_lines(oid):
+    return {otp.pid: otp for otp in
+            OrderToPart.query.filter_by(deleted=False, oid=oid).all()}
+
+
+def parse_order_lines(form):
+    # Form fields come in pairs named <pid>_current and <pid>_price
+    lines = {}
+    for key in form.keys():
+        pid, _, field = key.partition('_')
+        if field == 'current' and pid.isdigit():
+            lines[int(pid)] = (int(form[key]),
+                               float(form['{0}_price'.format(pid)]))
+    if lines:
+        live = Part.query.with_entities(Part.pid) \
+            .filter(Part.pid.in_(lines.keys()),
+                    Part.deleted == False)  # noqa: E712
+        live = {pid for (pid,) in live.all()}
+        lines = {pid: v for pid, v in lines.items() if pid in live}
+    return lines
+
+
+def save_order_lines(oid, lines):
+    # Write only the lines that changed, as one bulk UPDATE and one bulk
+    # INSERT, within the caller's transaction
+    existing = get_order_lines(oid)
+    updates = []
+    inserts = []
+    deltas = {}
+    for pid, (quantity, price) in sorted(lines.items()):
+        otp = existing.get(pid)
+        if otp is not None:
+            if otp.quantity != quantity or float(otp.price or 0) != price:
+                updates.append({'otpid': otp.otpid, 'quantity': quantity,
+                                'price': price})
+                deltas[pid] = quantity - (otp.quantity or 0)
+        elif quantity != 0:
+            inserts.append({'oid': oid, 'pid': pid, 'quantity': quantity,
+                            'price': price, 'deleted': False})
+            deltas[pid] = quantity
+    if inserts:
+        db.session.bulk_insert_mappings(OrderToPart, inserts)
+    if updates:
+        db.session.bulk_update_mappings(OrderToPart, updates)
+    adjust_reserved(deltas)
+    return len(updates) + len(inserts)
+
+
+def adjust_reserved(deltas):
+    # Apply {pid: change} to Part.reserved as one executemany UPDATE. The
+    # increment happens in SQL so concurrent saves don't lose updates.
+    params = [{'_pid': pid, '_delta': delta}
+              for pid, delta in deltas.items() if delta]
+    if not params:
+        return
+    stmt = Part.__table__.update() \
+        .where(Part.__table__.c.pid == db.bindparam('_pid')) \
+        .values(reserved=Part.__table__.c.reserved + db.bindparam('_delta'))
+    db.session.execute(stmt, params)
+
+
+def reconcile_reserved():
+    # Rebuild Part.reserved from order_to_part, returning how many parts
+    # had drifted
+    actual = db.session.query(db.func.coalesce(
+        db.func.sum(OrderToPart.quantity), 0)) \
+        .filter(OrderToPart.pid == Part.pid,
+                OrderToPart.deleted == db.false()) \
+        .correlate(Part) \
+        .as_scalar()
+    drifted = Part.query.filter(Part.reserved != actual).count()
+    Part.query.update({Part.reserved: actual}, synchronize_session=False)
+    db.session.commit()
+    return drifted
+
+
+def checked_ids(form):
+    # List pages post one delete_<id> checkbox per selected row
+    return [int(k.split('_')[1]) for k in form.keys()
+            if k.startswith('delete_')]
+
+
+def bulk_criteria(model, args):
+    # <column>=value, <column>_before=value and <column>_after=value
+    criteria = []
+    columns = model.__table__.columns
+    try:
+        for name, value in args.items():
+            if name.endswith('_before') and name[:-7] in columns:
+                column = columns[name[:-7]]
+                criteria.append(column < csv_value(column, value))
+            elif name.endswith('_after') and name[:-6] in columns:
+                column = columns[name[:-6]]
+                criteria.append(column > csv_value(column, value))
+            elif name in columns and name != 'deleted':
+                column = columns[name]
+                criteria.append(column == csv_value(column, value))
+            else:
+                fk.abort(400)
+    except ValueError:
+        fk.abort(400)
+    return criteria
+
+
+def soft_delete(model, ids=None, criteria=(), deleted=True):
+    # Set deleted on the matching rows with one UPDATE per table, inside
+    # the caller's transaction. Orders cascade to their lines, and lines
+    # give back (or retake) the part quantities they reserve. Returns
+    # {table name: rows changed}.
+    key = model.__mapper__.primary_key[0]
+    query = model.query.filter(model.deleted == (db.false() if deleted
+                                                 else db.true()),
+                               *criteria)
+    if ids is not None:
+        query = query.filter(key.in_(ids))
+    counts = {}
+    if model is Order:
+        oids = query.with_entities(Order.oid).subquery()
+        lines = OrderToPart.query.filter(
+            OrderToPart.oid.in_(db.select([oids.c.oid])),
+            OrderToPart.deleted == (db.false() if deleted else db.true()))
+        release_reserved(lines, deleted)
+        counts[OrderToPart.__tablename__] = lines.update(
+            {OrderToPart.deleted: deleted}, synchronize_session=False)
+    elif model is OrderToPart:
+        release_reserved(query, deleted)
+    counts[model.__tablename__] = query.update({model.deleted: deleted},
+                                               synchronize_session=False)
+    return counts
+
+
+def release_reserved(lines, deleted):
+    # Take the quantities of the order lines about to be deleted off
+    # Part.reserved, or put them back on when restoring
+    sign = -1 if deleted else 1
+    rows = lines.with_entities(OrderToPart.pid,
+                               db.func.sum(OrderToPart.quantity)) \
+        .group_by(OrderToPart.pid) \
+        .all()
+    adjust_reserved({pid: sign * (quantity or 0) for pid, quantity in rows})
+
+
+def encode_cursor(values):
+    # Dates go in as YYYY-MM-DD text, paginate() turns them back
+    raw = json.dumps(values, default=str).encode('utf8')
+    return base64.urlsafe_b64encode(raw).decode('ascii')
+
+
+def decode_cursor(cursor):
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except (ValueError, TypeError):
+        fk.abort(400)
+
+
+def paginate(query, key, sort_columns):
+    # Keyset pagination: seek past the (sort, key) values of the last row
+    # seen instead of using OFFSET, so every page costs the same
+    args = fk.request.args
+    try:
+        size = int(args.get('size', app.config['PAGE_SIZE']))
+    except ValueError:
+        fk.abort(400)
+    size = max(1, min(size, app.config['MAX_PAGE_SIZE']))
+    sort = args.get('sort')
+    if sort not in sort_columns:
+        sort = None
+    columns = [sort_columns[sort], key] if sort else [key]
+    after = args.get('after')
+    before = args.get('before')
+    cursor = decode_cursor(before or after) if before or after else None
+    if cursor is not None:
+        if len(cursor) != len(columns):
+            fk.abort(400)
+        try:
+            cursor = [csv_value(c, v)
+                      if v is not None and isinstance(c.type, db.Date) else v
+                      for c, v in zip(columns, cursor)]
+        except ValueError:
+            fk.abort(400)
+        query = query.filter(seek_condition(columns, cursor, bool(before)))
+    # NULLs go last whichever backend this is, see seek_condition()
+    if before:
+        order = [c.desc() for c in columns]
+        if sort:
+            order[0] = order[0].nullsfirst()
+    else:
+        order = list(columns)
+        if sort:
+            order[0] = order[0].nullslast()
+    query = query.order_by(*order)
+    rows = query.limit(size + 1).all()
+    more = len(rows) > size
+    rows = rows[:size]
+    if before:
+        rows.reverse()
+    has_prev = more if before else after is not None
+    has_next = True if before else more
+    page = {'size': size, 'sort': sort, 'prev': None, 'next': None}
+    if rows and has_prev:
+        page['prev'] = encode_cursor([getattr(rows[0], c.key)
+                                      for c in columns])
+    if rows and has_next:
+        page['next'] = encode_cursor([getattr(rows[-1], c.key)
+                                      for c in columns])
+    return rows, page
+
+
+def seek_condition(columns, values, backwards):
+    # Expands (a, b) > (x, y) as a > x OR (a = x AND b > y), which every
+    # backend can serve from an index on the leading column. NULLs sort
+    # after every value and never compare equal, so they get IS NULL terms
+    column, value = columns[0], values[0]
+    if value is None:
+        # Only NULLs follow a NULL, and every value comes before one
+        strict = column.isnot(None) if backwards else db.false()
+        same = column.is_(None)
+    else:
+        strict = column < value if backwards else \
+            db.or_(column > value, column.is_(None))
+        same = column == value
+    if len(columns) == 1:
+        return strict
+    return db.or_(strict, db.and_(same,
+                                  seek_condition(columns[1:], values[1:],
+                                                 backwards)))
+
+
+def normalize_address(address):
+    address = re.sub(r'\s*,\s*', ', ', address.strip().upper())
+    return ' '.join(address.split())
+
+
 def get_lat_lon(address):
-    url = 'https://geocoding.geo.census.gov/geocoder/locations/onelineaddress?'
-    params = ['address=' + '+'.join(address.split()),
-              'benchmark=9',
-              'format=json']
-    url += '&'.join(params)
-    response = requests.get(url=url)
-    if not response.ok or not json.loads(response.text):
+    return geocode_batch([address])[address]
+
+
+def geocode_batch(addresses):
+    res = {}
+    for address, entry in geocode_entries(addresses).items():
+        if entry is not None and entry.lat is not None:
+            res[address] = entry.lat, entry.lon
+        else:
+            res[address] = 0, 0
+    return res
+
+
+def geocode_entries(addresses):
+    # Resolve every address through the geocode cache, sending only the
+    # distinct, missing or expired ones upstream in a single request.
+    # Addresses with no cache entry at all failed in transit.
+    keys = {a: normalize_address(a) for a in addresses}
+    unique = sorted(set(keys.values()))
+    cached = {}
+    for i in range(0, len(unique), 500):
+        chunk = unique[i:i + 500]
+        for entry in GeocodeCache.query.filter(
+                GeocodeCache.address.in_(chunk)).all():
+            cached[entry.address] = entry
+    now = dt.datetime.utcnow()
+    missing = [k for k in unique
+               if k not in cached or not cached[k].is_fresh(now)]
+    if missing:
+        for key, xy in census_geocode(missing).items():
+            entry = cached.get(key)
+            if entry is None:
+                entry = GeocodeCache(address=key)
+                cached[key] = entry
+            entry.lat, entry.lon = xy if xy else (None, None)
+            entry.time_checked = now
+            db.session.add(entry)
+    return {address: cached.get(key) for address, key in keys.items()}
+
+
+def geocode_pending_sites(chunk=1000):
+    # Resolve pending sites a chunk at a time through the batch geocoder.
+    # Sites whose lookup failed in transit stay pending.
+    resolved = 0
+    last = 0
+    while True:
+        pending = Site.query.filter(Site.geocode_status == 'pending',
+                                    Site.sid > last) \
+            .order_by(Site.sid) \
+            .limit(chunk) \
+            .all()
+        if not pending:
+            return resolved
+        entries = geocode_entries([s.address for s in pending])
+        for s in pending:
+            entry = entries[s.address]
+            if entry is None:
+                continue
+            if entry.lat is None:
+                s.geocode_status = 'failed'
+            else:
+                s.lat, s.lon = entry.lat, entry.lon
+                s.geocode_status = 'done'
+                resolved += 1
+        last = pending[-1].sid
+        db.session.commit()
+
+
+def census_geocode(keys):
+    # Returns {address: (lat, lon)} with None for addresses the geocoder
+    # could not match. Addresses that failed in transit are left out so
+    # they are retried rather than cached as misses.
+    if len(keys) == 1:
+        return census_geocode_one(keys[0])
+    res = {}
+    for i in range(0, len(keys), 10000):
+        res.update(census_geocode_many(keys[i:i + 10000]))
+    return res
+
+
+def census_geocode_one(address):
+    url = app.config['GEOCODER_URL'] + '/locations/onelineaddress'
+    params = {'address': address, 'benchmark': 9, 'format': 'json'}
+    try:
+        with measure('http'):
+            response = requests.get(url=url, params=params,
+                                    timeout=app.config['GEOCODER_TIMEOUT'])
+    except requests.RequestException as e:
+        print('failed request', e)
+        return {}
+    if not response.ok or not response.text:
         print('failed request', response.reason, response.text)
-    else:
+        return {}
+    try:
         matches = json.loads(response.text)['result']['addressMatches']
-        if len(matches) > 0:
-            xy = matches[0]['coordinates']
-            lat = xy['x']
-            lon = xy['y']
-            return lat, lon
+    except (ValueError, KeyError, TypeError):
+        # A body that isn't the JSON we expect is a failure in transit
+        print('unreadable response', response.text[:200])
+        return {}
+    if len(matches) == 0:
+        print('no matches for address!')
+        return {address: None}
+    # The geocoder reports x as longitude and y as latitude
+    xy = matches[0]['coordinates']
+    return {address: (xy['y'], xy['x'])}
+
+
+def census_geocode_many(keys):
+    url = app.config['GEOCODER_URL'] + '/locations/addressbatch'
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    for i, key in enumerate(keys):
+        writer.writerow([i] + split_address(key))
+    try:
+        with measure('http'):
+            response = requests.post(url=url, data={'benchmark': 9},
+                                     files={'addressFile': ('addresses.csv',
+                                                            buf.getvalue())},
+                                     timeout=app.config['GEOCODER_TIMEOUT'])
+    except requests.RequestException as e:
+        print('failed batch request', e)
+        return {}
+    if not response.ok:
+        print('failed batch request', response.reason, response.text)
+        return {}
+    res = {}
+    for row in csv.reader(io.StringIO(response.text)):
+        if len(row) < 3 or not row[0].isdigit() or int(row[0]) >= len(keys):
+            continue
+        key = keys[int(row[0])]
+        if row[2] == 'Match' and len(row) > 5:
+            try:
+                lon, lat = row[5].split(',')
+                res[key] = float(lat), float(lon)
+            except ValueError:
+                # Left out, so it is retried like a failed request
+                print('unreadable coordinates', row[5])
         else:
-            print('no matches for address!')
-    return 0, 0
+            res[key] = None
+    return res
+
+
+def split_address(address):
+    # Batch rows want street, city, state and ZIP in separate columns
+    parts = [p.strip() for p in address.split(',')]
+    street = parts[0]
+    city = parts[1] if len(parts) > 2 else ''
+    state, zip_code = '', ''
+    if len(parts) > 1:
+        tail = parts[-1].split()
+        if tail and tail[-1].isdigit():
+            zip_code = tail.pop()
+        state = ' '.join(tail)
+    return [street, city, state, zip_code]
+
+
+def sync_id_sequences():
+    # Rows inserted with explicit IDs before the database assigned them
+    # leave Postgres sequences behind max(id); move them past it
+    if db.engine.dialect.name != 'postgresql':
+        return
+    for model in [Client, Site, Order, Part, OrderToPart, User]:
+        table = model.__table__
+        key = table.primary_key.columns.values()[0].name
+        db.session.execute(
+            "SELECT setval(pg_get_serial_sequence('{0}', '{1}'), "
+            "COALESCE((SELECT MAX({1}) FROM {0}), 0) + 1, false)"
+            .format(table.name, key))
+    db.session.commit()
 
 
 def reinitialize_demo_db():
-    db.drop_all()
+    # Keep the geocode cache so reseeding doesn't repeat lookups
+    db.metadata.drop_all(bind=db.engine,
+                         tables=[t for t in db.metadata.sorted_tables
+                                 if t.name != 'geocode_cache'])
     db.create_all()
     demo_clients = [['Jan Levinson', 'White Pages'],
                     ['John Rammel', 'Prestige Postal Company'],
@@ -536,12 +1542,18 @@ def reinitialize_demo_db():
                   '100 Adams Ave, Scranton, PA 18503',
                   '800 Linden St, Scranton, PA 18510',
                   '601 Jefferson Ave, Scranton, PA 18510']
+    coords = geocode_entries(demo_sites)
     for address in demo_sites:
-        lat, lon = get_lat_lon(address)
+        entry = coords[address]
         new_site = Site(address=address,
-                        lat=lat,
-                        lon=lon,
                         deleted=False)
+        if entry is None:
+            new_site.geocode_status = 'pending'
+        elif entry.lat is None:
+            new_site.geocode_status = 'failed'
+        else:
+            new_site.lat, new_site.lon = entry.lat, entry.lon
+            new_site.geocode_status = 'done'
         db.session.add(new_site)
     demo_parts = [['100# cast coated',
                    '100 lb basis weight thick and shiny paper',
@@ -589,7 +1601,7 @@ def reinitialize_demo_db():
         cid, sid, due, status = order
         new_order = Order(cid=cid,
                           sid=sid,
-                          due=due,
+                          due=parse_day(due),
                           status=status,
                           deleted=False)
         db.session.add(new_order)
@@ -614,6 +1626,1760 @@ def reinitialize_demo_db():
                      password=bcrypt.hashpw(pw, bcrypt.gensalt()))
     db.session.add(demo_user)
     db.session.commit()
+    reconcile_reserved()
+###############################################################################
+
+# Background Jobs #############################################################
+
+
+class GeocodeQueue(object):
+    # In-process job queue that fills in Site.lat/lon off the request path.
+    # Jobs that fail in transit are retried with exponential backoff.
+
+    def __init__(self):
+        self.jobs = queue.Queue()
+        self.lock = threading.Lock()
+        self.threads = []
+        self.retrying = 0
+        self.running = 0
+        self.done = 0
+        self.failed = 0
+        self.failures = collections.deque(maxlen=50)
+
+    def start(self):
+        with self.lock:
+            if self.threads:
+                return
+            for i in range(app.config['GEOCODE_WORKERS']):
+                t = threading.Thread(target=self.work,
+                                     name='geocode-{0}'.format(i))
+                t.daemon = True
+                t.start()
+                self.threads.append(t)
+
+    def submit(self, sid, attempt=1):
+        if app.config['GEOCODE_WORKERS'] == 0:
+            try:
+                self.run(sid, attempt)
+            except Exception as e:
+                self.retry_or_fail(sid, attempt, repr(e))
+            return
+        self.start()
+        self.jobs.put((sid, attempt))
+
+    def retry(self, sid, attempt):
+        def resubmit():
+            with self.lock:
+                self.retrying -= 1
+            self.jobs.put((sid, attempt))
+        delay = app.config['GEOCODE_RETRY_DELAY'] * 2 ** (attempt - 2)
+        with self.lock:
+            self.retrying += 1
+        timer = threading.Timer(delay, resubmit)
+        timer.daemon = True
+        timer.start()
+
+    def work(self):
+        while True:
+            sid, attempt = self.jobs.get()
+            with self.lock:
+                self.running += 1
+            try:
+                self.run(sid, attempt)
+            except Exception as e:
+                self.retry_or_fail(sid, attempt, repr(e))
+            finally:
+                with self.lock:
+                    self.running -= 1
+                self.jobs.task_done()
+
+    def run(self, sid, attempt):
+        with app.app_context():
+            s = Site.query.get(sid)
+            if s is None or s.geocode_status != 'pending':
+                return
+            entry = geocode_entries([s.address])[s.address]
+            if entry is None:
+                self.retry_or_fail(sid, attempt, 'geocoder unavailable')
+                return
+            if entry.lat is None:
+                s.geocode_status = 'failed'
+                self.record_failure(sid, attempt, 'no match')
+            else:
+                s.lat, s.lon = entry.lat, entry.lon
+                s.geocode_status = 'done'
+                with self.lock:
+                    self.done += 1
+            db.session.commit()
+
+    def retry_or_fail(self, sid, attempt, reason):
+        # Inline (no workers) there is nothing to run a retry, and sleeping
+        # out the backoff would hold up the request
+        if attempt < app.config['GEOCODE_MAX_ATTEMPTS'] and \
+                app.config['GEOCODE_WORKERS'] > 0:
+            self.retry(sid, attempt + 1)
+            return
+        with app.app_context():
+            db.session.rollback()
+            Site.query.filter_by(sid=sid, geocode_status='pending') \
+                .update({Site.geocode_status: 'failed'},
+                        synchronize_session=False)
+            db.session.commit()
+        self.record_failure(sid, attempt, reason)
+
+    def record_failure(self, sid, attempt, reason):
+        with self.lock:
+            self.failed += 1
+            self.failures.append({'sid': sid, 'attempt': attempt,
+                                  'reason': reason,
+                                  'time': str(dt.datetime.utcnow())})
+
+    def stats(self):
+        with self.lock:
+            return {'workers': len(self.threads),
+                    'queued': self.jobs.qsize(),
+                    'retrying': self.retrying,
+                    'running': self.running,
+                    'done': self.done,
+                    'failed': self.failed,
+                    'failures': list(self.failures)}
+
+
+geocode_queue = GeocodeQueue()
+
+
+@app.before_first_request
+def resume_geocoding():
+    # Pick up sites left pending by a previous process
+    if app.config['GEOCODE_WORKERS'] == 0:
+        return
+    for s in Site.query.filter_by(geocode_status='pending').all():
+        geocode_queue.submit(s.sid)
+
+
+@app.route('/admin/geocode_queue')
+@fk_lg.login_required
+def geocode_queue_stats():
+    return fk.jsonify(geocode_queue.stats())
+
+
+class LoginBusy(Exception):
+    pass
+
+
+def verify_pw(hashed, pw, rounds):
+    # Runs on the login pool. Returns (matched, rehashed password or None);
+    # hashes made with fewer than BCRYPT_ROUNDS are upgraded on success.
+    hashed = bytes(hashed)
+    if not bcrypt.checkpw(pw.encode('utf8'), hashed):
+        return False, None
+    if int(hashed.split(b'$')[2]) < rounds:
+        return True, bcrypt.hashpw(pw.encode('utf8'),
+                                   bcrypt.gensalt(rounds=rounds))
+    return True, None
+
+
+class LoginPool(object):
+    # Bounded pool for bcrypt checks so a burst of logins can use at most
+    # LOGIN_WORKERS cores. Requests past LOGIN_QUEUE waiting checks are
+    # turned away instead of piling up.
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.executor = None
+        self.slots = None
+
+    def verify(self, hashed, pw):
+        with self.lock:
+            if self.executor is None:
+                self.executor = concurrent.futures.ThreadPoolExecutor(
+                    max_workers=app.config['LOGIN_WORKERS'])
+                self.slots = threading.BoundedSemaphore(
+                    app.config['LOGIN_WORKERS'] + app.config['LOGIN_QUEUE'])
+        if not self.slots.acquire(False):
+            raise LoginBusy()
+        try:
+            future = self.executor.submit(verify_pw, hashed, pw,
+                                          app.config['BCRYPT_ROUNDS'])
+        except Exception:
+            self.slots.release()
+            raise
+        # A check we stop waiting for still holds its slot until it is done
+        future.add_done_callback(lambda f: self.slots.release())
+        try:
+            return future.result(timeout=app.config['LOGIN_TIMEOUT'])
+        except concurrent.futures.TimeoutError:
+            raise LoginBusy()
+
+
+class RateLimiter(object):
+    # Fixed window counters per (kind, key), kinds being 'ip' and 'user'
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {}
+
+    def limit(self, kind):
+        if kind == 'ip':
+            return app.config['LOGIN_MAX_PER_IP']
+        return app.config['LOGIN_MAX_PER_USER']
+
+    def current(self, key, now):
+        started, count = self.counts.get(key, (now, 0))
+        if now - started >= app.config['LOGIN_WINDOW']:
+            return now, 0
+        return started, count
+
+    def allow(self, keys):
+        now = time.time()
+        with self.lock:
+            return all(self.current(k, now)[1] < self.limit(k[0])
+                       for k in keys)
+
+    def hit(self, keys):
+        now = time.time()
+        with self.lock:
+            if len(self.counts) > 100000:
+                self.counts = {k: v for k, v in self.counts.items()
+                               if now - v[0] < app.config['LOGIN_WINDOW']}
+            for k in keys:
+                started, count = self.current(k, now)
+                self.counts[k] = (started, count + 1)
+
+    def reset(self, keys):
+        with self.lock:
+            for k in keys:
+                self.counts.pop(k, None)
+
+
+login_pool = LoginPool()
+login_limiter = RateLimiter()
+###############################################################################
+
+# Import/Export ###############################################################
+
+
+CSV_CHUNK = 5000
+
+
+def csv_columns(model, writable=False):
+    # Timestamps are exported but always set by the database on import
+    columns = model.__table__.columns
+    if writable:
+        return [c for c in columns
+                if c.name not in ('time_created', 'time_modified')]
+    return list(columns)
+
+
+def csv_value(column, value):
+    if value is None or value == '':
+        return None
+    if isinstance(column.type, db.Boolean):
+        return value.strip().lower() in ('true', 't', '1', 'yes', 'y')
+    if isinstance(column.type, db.Integer):
+        return int(value)
+    if isinstance(column.type, db.Numeric):
+        return float(value)
+    if isinstance(column.type, db.Date):
+        day = parse_day(value)
+        if day is None:
+            raise ValueError('{0} is not a date: {1}'.format(column.name,
+                                                             value))
+        return day
+    return value
+
+
+def import_csv(entity, lines, geocode=True):
+    # Stream CSV text into the entity's table CSV_CHUNK rows at a time,
+    # using COPY on Postgres and batched executemany elsewhere. Returns
+    # the number of rows imported.
+    model = ENTITIES[entity]
+    reader = csv.DictReader(lines)
+    columns = [c for c in csv_columns(model, writable=True)
+               if c.name in (reader.fieldnames or [])]
+    if 'deleted' not in [c.name for c in columns]:
+        columns.append(model.__table__.c.deleted)
+    if model is Site and 'geocode_status' not in [c.name for c in columns]:
+        columns.append(Site.__table__.c.geocode_status)
+    count = 0
+    chunk = []
+    for record in reader:
+        row = {c.name: csv_value(c, record.get(c.name)) for c in columns}
+        if row['deleted'] is None:
+            row['deleted'] = False
+        if model is Site and row['geocode_status'] is None:
+            located = row.get('lat') is not None and \
+                row.get('lon') is not None
+            row['geocode_status'] = 'done' if located else 'pending'
+        chunk.append(row)
+        if len(chunk) == CSV_CHUNK:
+            count += write_csv_chunk(model, columns, chunk)
+            chunk = []
+    if chunk:
+        count += write_csv_chunk(model, columns, chunk)
+    db.session.commit()
+    backfill_time_modified(model)
+    sync_id_sequences()
+    if model in (Part, OrderToPart):
+        reconcile_reserved()
+    if model is Site and geocode:
+        geocode_pending_sites()
+    return count
+
+
+def write_csv_chunk(model, columns, rows):
+    names = [c.name for c in columns]
+    if db.engine.dialect.name != 'postgresql':
+        db.session.execute(model.__table__.insert(), rows)
+        return len(rows)
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    for row in rows:
+        # COPY's CSV format spells booleans t/f and NULL as an empty field
+        writer.writerow([('t' if row[n] else 'f')
+                         if isinstance(row[n], bool) else row[n]
+                         for n in names])
+    buf.seek(0)
+    cursor = db.session.connection().connection.cursor()
+    cursor.copy_expert('COPY {0} ({1}) FROM STDIN WITH CSV'.format(
+        model.__tablename__, ', '.join(names)), buf)
+    return len(rows)
+
+
+def export_csv(entity):
+    # Yields CSV text chunk by chunk from a server-side cursor, so memory
+    # stays flat however large the table is
+    model = ENTITIES[entity]
+    columns = csv_columns(model)
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow([c.name for c in columns])
+    query = db.select(columns).order_by(*model.__table__.primary_key.columns)
+    conn = db.engine.connect().execution_options(stream_results=True)
+    try:
+        result = conn.execute(query)
+        while True:
+            rows = result.fetchmany(CSV_CHUNK)
+            if not rows:
+                break
+            writer.writerows(rows)
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+        yield buf.getvalue()
+    finally:
+        conn.close()
+
+
+@app.route('/export/<entity>.csv')
+@fk_lg.login_required
+def export_entity(entity):
+    if entity not in ENTITIES:
+        fk.abort(404)
+    headers = {'Content-Disposition':
+               'attachment; filename={0}.csv'.format(entity)}
+    return fk.Response(export_csv(entity), mimetype='text/csv',
+                       headers=headers)
+
+
+@app.route('/import/<entity>', methods=['POST'])
+@fk_lg.login_required
+def import_entity(entity):
+    if entity not in ENTITIES or 'file' not in fk.request.files:
+        fk.abort(400)
+    # Werkzeug spools uploads to a SpooledTemporaryFile, which
+    # io.TextIOWrapper can't wrap before Python 3.11
+    lines = codecs.getreader('utf8')(fk.request.files['file'].stream)
+    # Sites are geocoded in batches after the response, off the request
+    try:
+        count = import_csv(entity, lines, geocode=False)
+    except (ValueError, csv.Error) as e:
+        db.session.rollback()
+        return fk.jsonify({'entity': entity, 'error': str(e)}), 400
+    except (IntegrityError, DataError) as e:
+        # e.g. re-uploading an export, whose IDs are already taken. The
+        # whole file is one transaction, so nothing was imported
+        db.session.rollback()
+        status = 409 if isinstance(e, IntegrityError) else 400
+        return fk.jsonify({'entity': entity,
+                           'error': str(e.orig).strip()}), status
+    if ENTITIES[entity] is Site:
+        run_in_background(geocode_pending_sites)
+    return fk.jsonify({'entity': entity, 'imported': count})
+
+
+def run_in_background(target):
+    def run():
+        with app.app_context():
+            target()
+    t = threading.Thread(target=run)
+    t.daemon = True
+    t.start()
+###############################################################################
+
+# API #########################################################################
+
+
+def api_query(model):
+    if model is Order:
+        return order_query()
+    return model.query.filter_by(deleted=False)
+
+
+def api_fields(rows):
+    # ?fields=a,b trims every row to the named keys
+    fields = fk.request.args.get('fields')
+    if not fields:
+        return rows
+    fields = fields.split(',')
+    if rows and not set(fields) <= set(rows[0]):
+        fk.abort(400)
+    return [{f: row[f] for f in fields} for row in rows]
+
+
+def last_modified(rows):
+    stamps = [r.time_modified or r.time_created for r in rows]
+    stamps = [t.replace(tzinfo=None) - (t.utcoffset() or dt.timedelta())
+              for t in stamps if t is not None]
+    return max(stamps) if stamps else None
+
+
+def api_response(payload, rows=()):
+    # Tag the uncompressed body, answer 304 when the client already has
+    # it, and gzip what is left for clients that accept it. Last-Modified
+    # comes from rows, which must be every row the payload was built from
+    body = json.dumps(payload, sort_keys=True)
+    response = fk.Response(body, mimetype='application/json')
+    response.set_etag(hashlib.md5(body.encode('utf8')).hexdigest(),
+                      weak=True)
+    modified = last_modified(rows)
+    if modified is not None:
+        response.last_modified = modified
+    response.headers['Vary'] = 'Accept-Encoding'
+    response.make_conditional(fk.request)
+    if response.status_code == 200 and len(body) > 500 and \
+            'gzip' in fk.request.headers.get('Accept-Encoding', ''):
+        response.set_data(gzip.compress(response.get_data()))
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+
+@app.route('/api/v1/<entity>')
+@fk_lg.login_required
+@replica_reads
+def api_list(entity):
+    if entity not in ENTITIES:
+        fk.abort(404)
+    model = ENTITIES[entity]
+    key = model.__mapper__.primary_key[0]
+    rows, page = paginate(api_query(model), key, SORT_COLUMNS[model])
+    payload = {'data': api_fields([r.to_dict() for r in rows]),
+               'next': page['next'], 'prev': page['prev'],
+               'size': page['size'], 'sort': page['sort']}
+    # The page rows can't tell when a row left the page or a joined name
+    # changed, so lists are validated on the ETag alone
+    return api_response(payload)
+
+
+@app.route('/api/v1/<entity>/<int:id_val>')
+@fk_lg.login_required
+@replica_reads
+def api_detail(entity, id_val):
+    if entity not in ENTITIES:
+        fk.abort(404)
+    row = ENTITIES[entity].query.get_or_404(id_val)
+    rows = [row]
+    if isinstance(row, Order):
+        # to_dict() includes the client name and site address
+        rows += [r for r in (row.client, row.site) if r is not None]
+    return api_response(api_fields([row.to_dict()])[0], rows)
+
+
+def backfill_time_modified(model):
+    # Rows written before time_modified had an insert default (or loaded
+    # with COPY) still have it NULL, which would hide them from the feed
+    table = model.__table__
+    db.session.execute(table.update()
+                       .where(table.c.time_modified == None)  # noqa: E711
+                       .values(time_modified=db.func.coalesce(
+                           table.c.time_created, db.func.now())))
+    db.session.commit()
+
+
+def change_feed(since=None, limit=None):
+    # Rows of every entity changed after the cursor, soft deletes included,
+    # in (time_modified, table, id) order. Returns (changes, next cursor).
+    limit = limit or app.config['CHANGE_FEED_LIMIT']
+    if since:
+        cursor = decode_cursor(since)
+        if len(cursor) != 3:
+            fk.abort(400)
+        mark, mark_table, mark_id = cursor
+    cutoff = dt.datetime.now(dt.timezone.utc) - \
+        dt.timedelta(seconds=app.config['CHANGE_FEED_LAG'])
+    if db.engine.dialect.name == 'sqlite':
+        cutoff = cutoff.replace(tzinfo=None)
+    rows = []
+    for name, model in sorted(ENTITIES.items()):
+        changed = model.time_modified
+        key = model.__mapper__.primary_key[0]
+        # Timestamps go back in as the text they came out as, which both
+        # SQLite string comparison and Postgres casting agree on
+        query = model.query.filter(
+            changed <= db.literal(str(cutoff), db.String))
+        if since:
+            mark_lit = db.literal(mark, db.String)
+            if name > mark_table:
+                query = query.filter(changed >= mark_lit)
+            elif name == mark_table:
+                query = query.filter(db.or_(changed > mark_lit,
+                                            db.and_(changed == mark_lit,
+                                                    key > mark_id)))
+            else:
+                query = query.filter(changed > mark_lit)
+        if model is Order:
+            query = query.options(db.joinedload(Order.client),
+                                  db.joinedload(Order.site))
+        for row in query.order_by(changed, key).limit(limit).all():
+            rows.append((row.time_modified, name,
+                         getattr(row, key.key), row))
+    rows.sort(key=lambda r: r[:3])
+    rows = rows[:limit]
+    changes = [{'table': name, 'id': id_val, 'changed': str(changed),
+                'deleted': bool(row.deleted), 'row': row.to_dict(),
+                'cursor': encode_cursor([str(changed), name, id_val])}
+               for changed, name, id_val, row in rows]
+    if changes:
+        since = changes[-1]['cursor']
+    return changes, since
+
+
+@app.route('/api/v1/changes')
+@fk_lg.login_required
+def api_changes():
+    # Long poll: with ?wait=N, hold the request up to N seconds until
+    # something changes
+    since = fk.request.args.get('since')
+    limit = min(fk.request.args.get('limit', type=int) or
+                app.config['CHANGE_FEED_LIMIT'], app.config['MAX_PAGE_SIZE'])
+    wait = min(fk.request.args.get('wait', 0, type=int),
+               app.config['CHANGE_FEED_MAX_WAIT'])
+    deadline = time.time() + wait
+    changes, cursor = change_feed(since, limit)
+    while not changes and time.time() < deadline:
+        db.session.remove()
+        time.sleep(app.config['CHANGE_FEED_POLL'])
+        changes, cursor = change_feed(since, limit)
+    return fk.jsonify({'changes': changes, 'next': cursor})
+
+
+@app.route('/api/v1/changes/stream')
+@fk_lg.login_required
+def api_changes_stream():
+    # Server-sent events, resuming from Last-Event-ID on reconnect. The
+    # stream ends after CHANGE_FEED_STREAM_SECONDS so clients reconnect.
+    since = fk.request.headers.get('Last-Event-ID') or \
+        fk.request.args.get('since')
+
+    def events(since):
+        deadline = time.time() + app.config['CHANGE_FEED_STREAM_SECONDS']
+        while time.time() < deadline:
+            changes, since = change_feed(since)
+            db.session.remove()
+            for change in changes:
+                yield 'id: {0}\ndata: {1}\n\n'.format(
+                    change['cursor'], json.dumps(change))
+            if not changes:
+                yield ': keepalive\n\n'
+                time.sleep(app.config['CHANGE_FEED_POLL'])
+    return fk.Response(fk.stream_with_context(events(since)),
+                       mimetype='text/event-stream',
+                       headers={'Cache-Control': 'no-cache'})
+###############################################################################
+
+# Routing #####################################################################
+
+
+EARTH_RADIUS_KM = 6371.0
+OPEN_STATUSES = ['Order placed', 'Delivery scheduled', 'Driver dispatched']
+
+
+def haversine_matrix(lat, lon):
+    # Great circle distance in km between every pair of points
+    lat = np.radians(np.asarray(lat, dtype=float))
+    lon = np.radians(np.asarray(lon, dtype=float))
+    dlat = lat[:, None] - lat[None, :]
+    dlon = lon[:, None] - lon[None, :]
+    a = np.sin(dlat / 2) ** 2 + \
+        np.cos(lat)[:, None] * np.cos(lat)[None, :] * np.sin(dlon / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def nearest_neighbor_tour(dist):
+    # Closed tour over every node starting and ending at node 0
+    n = len(dist)
+    tour = [0]
+    unvisited = np.ones(n, dtype=bool)
+    unvisited[0] = False
+    for _ in range(n - 1):
+        row = np.where(unvisited, dist[tour[-1]], np.inf)
+        nxt = int(np.argmin(row))
+        tour.append(nxt)
+        unvisited[nxt] = False
+    tour.append(0)
+    return np.array(tour)
+
+
+def two_opt(tour, dist, deadline):
+    # Best-improvement 2-opt, scoring every j for a given i at once
+    improved = True
+    while improved and time.time() < deadline:
+        improved = False
+        for i in range(1, len(tour) - 2):
+            a, b = tour[i - 1], tour[i]
+            c, d = tour[i + 1:-1], tour[i + 2:]
+            delta = dist[a, c] + dist[b, d] - dist[a, b] - dist[c, d]
+            j = int(np.argmin(delta))
+            if delta[j] < -1e-9:
+                tour[i:i + j + 2] = tour[i:i + j + 2][::-1].copy()
+                improved = True
+            if time.time() >= deadline:
+                break
+    return tour
+
+
+def or_opt(tour, dist, deadline):
+    # Move runs of 1-3 stops (either way round) to their cheapest edge
+    improved = True
+    while improved and time.time() < deadline:
+        improved = False
+        for size in (1, 2, 3):
+            i = 1
+            while i + size < len(tour) and time.time() < deadline:
+                seg = tour[i:i + size]
+                prev, nxt = tour[i - 1], tour[i + size]
+                gain = dist[prev, seg[0]] + dist[seg[-1], nxt] - \
+                    dist[prev, nxt]
+                rest = np.concatenate([tour[:i], tour[i + size:]])
+                u, v = rest[:-1], rest[1:]
+                forward = dist[u, seg[0]] + dist[seg[-1], v] - dist[u, v]
+                backward = dist[u, seg[-1]] + dist[seg[0], v] - dist[u, v]
+                cost = np.minimum(forward, backward)
+                k = int(np.argmin(cost))
+                if gain - cost[k] > 1e-9:
+                    if backward[k] < forward[k]:
+                        seg = seg[::-1]
+                    tour = np.concatenate([rest[:k + 1], seg, rest[k + 1:]])
+                    improved = True
+                else:
+                    i += 1
+    return tour
+
+
+def tour_length(tour, dist):
+    return float(dist[tour[:-1], tour[1:]].sum())
+
+
+def solve_routes(lat, lon, depot, vehicles, budget):
+    # Sweep the stops by bearing from the depot into equal sized groups,
+    # one per vehicle, then order each group with nearest neighbor and
+    # improve it with 2-opt and or-opt until its share of the budget runs
+    # out. Returns a list of (stop indices, km) per vehicle.
+    lat = np.asarray(lat, dtype=float)
+    lon = np.asarray(lon, dtype=float)
+    if len(lat) == 0:
+        return []
+    angle = np.arctan2(lat - depot[0], (lon - depot[1]) *
+                       np.cos(np.radians(depot[0])))
+    order = np.argsort(angle, kind='mergesort')
+    groups = [g for g in np.array_split(order, max(1, vehicles)) if len(g)]
+    started = time.time()
+    routes = []
+    for g in groups:
+        share = budget * len(g) / float(len(lat))
+        deadline = min(time.time() + share, started + budget)
+        dist = haversine_matrix(np.concatenate([[depot[0]], lat[g]]),
+                                np.concatenate([[depot[1]], lon[g]]))
+        tour = nearest_neighbor_tour(dist)
+        tour = two_opt(tour, dist, deadline)
+        tour = or_opt(tour, dist, deadline)
+        routes.append(([int(g[t - 1]) for t in tour[1:-1]],
+                       tour_length(tour, dist)))
+    return routes
+
+
+def plan_deliveries(due, vehicles=None, budget=None):
+    # Routes for the open orders due on a date, one stop per site
+    due = parse_day(due)
+    vehicles = vehicles or app.config['ROUTE_VEHICLES']
+    budget = budget or app.config['ROUTE_TIME_BUDGET']
+    stops = collections.OrderedDict()
+    unrouted = []
+    for o in order_query(due=due).filter(Order.status.in_(OPEN_STATUSES)) \
+            .order_by(Order.oid).all():
+        if o.site is None or o.site.lat is None or o.site.lon is None:
+            unrouted.append(o.to_dict())
+            continue
+        if o.sid not in stops:
+            stops[o.sid] = {'sid': o.sid, 'address': o.site.address,
+                            'lat': float(o.site.lat),
+                            'lon': float(o.site.lon), 'orders': []}
+        stops[o.sid]['orders'].append(o.to_dict())
+    stops = list(stops.values())
+    lat = [st['lat'] for st in stops]
+    lon = [st['lon'] for st in stops]
+    depot = app.config['ROUTE_DEPOT']
+    if depot is None and stops:
+        depot = (float(np.mean(lat)), float(np.mean(lon)))
+    started = time.time()
+    routes = solve_routes(lat, lon, depot, vehicles, budget)
+    return {'due': str(due), 'depot': depot, 'vehicles': vehicles,
+            'routes': [{'vehicle': i + 1,
+                        'distance_km': round(km, 2),
+                        'stops': [stops[k] for k in route]}
+                       for i, (route, km) in enumerate(routes)],
+            'unrouted': unrouted,
+            'solve_seconds': round(time.time() - started, 3)}
+
+
+def route_args():
+    due = parse_day(fk.request.args.get('date') or dt.datetime.utcnow())
+    if due is None:
+        fk.abort(400)
+    vehicles = fk.request.args.get('vehicles', type=int)
+    return due, vehicles
+
+
+@app.route('/routes/')
+@fk_lg.login_required
+@replica_reads
+def routes():
+    due, vehicles = route_args()
+    return fk.render_template('routes.html',
+                              plan=plan_deliveries(due, vehicles))
+
+
+@app.route('/api/v1/routes')
+@fk_lg.login_required
+@replica_reads
+def api_routes():
+    due, vehicles = route_args()
+    return fk.jsonify(plan_deliveries(due, vehicles))
+###############################################################################
+
+# Schedule ####################################################################
+
+
+def schedule(start, end, status=None):
+    # Orders due from start to end inclusive, one entry per day with its
+    # orders grouped by status in workflow order. The date range is an
+    # index range scan on orders.due.
+    query = order_query().filter(Order.due >= start, Order.due <= end)
+    if status:
+        query = query.filter(Order.status == status)
+    rank = {name: i for i, (_, name) in enumerate(ORDER_STATUSES)}
+    days = collections.OrderedDict()
+    for o in query.order_by(Order.due, Order.oid).all():
+        days.setdefault(o.due, {}).setdefault(o.status, []) \
+            .append(o.to_dict())
+    return [{'day': str(day), 'count': sum(len(v) for v in by.values()),
+             'statuses': [{'status': name, 'orders': by[name]}
+                          for name in sorted(by, key=lambda n: (
+                              rank.get(n, len(rank)), n or ''))]}
+            for day, by in days.items()]
+
+
+def schedule_args():
+    args = fk.request.args
+    start = parse_day(args.get('start') or dt.datetime.utcnow())
+    end = parse_day(args.get('end')) if args.get('end') else \
+        start and start + dt.timedelta(days=app.config['SCHEDULE_DAYS'] - 1)
+    if start is None or end is None or end < start or \
+            (end - start).days >= app.config['SCHEDULE_MAX_DAYS']:
+        fk.abort(400)
+    return start, end, args.get('status') or None
+
+
+@app.route('/schedule/')
+@fk_lg.login_required
+@replica_reads
+def due_schedule():
+    start, end, status = schedule_args()
+    return fk.render_template('schedule.html', start=start, end=end,
+                              status=status, days=schedule(start, end, status),
+                              statuses=[name for _, name in ORDER_STATUSES])
+
+
+@app.route('/api/v1/schedule')
+@fk_lg.login_required
+@replica_reads
+def api_schedule():
+    # ?start=YYYY-MM-DD&end=YYYY-MM-DD&status=
+    start, end, status = schedule_args()
+    return fk.jsonify({'start': str(start), 'end': str(end),
+                       'status': status,
+                       'days': schedule(start, end, status)})
+###############################################################################
+
+# Spatial Index ###############################################################
+
+
+def haversine(lat1, lon1, lat2, lon2):
+    dlat = math.radians(lat2 - lat1)
+    dlon = math.radians(lon2 - lon1)
+    a = math.sin(dlat / 2) ** 2 + math.cos(math.radians(lat1)) * \
+        math.cos(math.radians(lat2)) * math.sin(dlon / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * math.asin(math.sqrt(min(1.0, a)))
+
+
+class SyncedIndex(object):
+    # In-memory index that follows a table through time_modified, so writes
+    # from any path or process show up within <config>_REFRESH seconds.
+    # Subclasses name the model, the columns to pull and how to apply a row.
+    model = None
+    config = None
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.watermark = None
+        self.synced = 0
+        self.built = 0
+        self.clear()
+
+    def sync(self, force=False):
+        now = time.time()
+        with self.lock:
+            if not force and now - self.synced < \
+                    app.config[self.config + '_REFRESH']:
+                return
+            if now - self.built > app.config[self.config + '_REBUILD']:
+                self.clear()
+                self.watermark = None
+                self.built = now
+            model = self.model
+            query = model.query.with_entities(model.time_modified,
+                                              *self.columns())
+            if self.watermark is not None:
+                # Same text comparison as the change feed
+                query = query.filter(model.time_modified >=
+                                     db.literal(self.watermark, db.String))
+            for row in query.all():
+                self.apply(*row[1:])
+                if row[0] is not None and (self.watermark is None or
+                                           str(row[0]) > self.watermark):
+                    self.watermark = str(row[0])
+            self.synced = now
+
+
+class SiteIndex(SyncedIndex):
+    # Live, located sites bucketed into a lat/lon grid for radius and
+    # nearest neighbour lookups
+    model = Site
+    config = 'SITE_INDEX'
+
+    def clear(self):
+        self.cells = {}
+        self.sites = {}
+
+    def columns(self):
+        return Site.sid, Site.lat, Site.lon, Site.deleted
+
+    def apply(self, sid, lat, lon, deleted):
+        if deleted or lat is None or lon is None:
+            self.drop(sid)
+        else:
+            self.put(sid, float(lat), float(lon))
+
+    def cell(self, lat, lon):
+        size = app.config['SITE_INDEX_CELL']
+        return int(math.floor(lat / size)), int(math.floor(lon / size))
+
+    def put(self, sid, lat, lon):
+        self.drop(sid)
+        key = self.cell(lat, lon)
+        self.cells.setdefault(key, {})[sid] = (lat, lon)
+        self.sites[sid] = key
+
+    def drop(self, sid):
+        key = self.sites.pop(sid, None)
+        if key is not None:
+            del self.cells[key][sid]
+            if not self.cells[key]:
+                del self.cells[key]
+
+    def candidates(self, lat, lon, ring):
+        # Sites in the square ring of cells `ring` steps out from the
+        # cell holding (lat, lon), visiting only the ring's perimeter
+        row, col = self.cell(lat, lon)
+        if ring == 0:
+            cells = [(row, col)]
+        else:
+            cells = [(r, c) for r in (row - ring, row + ring)
+                     for c in range(col - ring, col + ring + 1)]
+            cells += [(r, c) for r in range(row - ring + 1, row + ring)
+                      for c in (col - ring, col + ring)]
+        for key in cells:
+            for sid, point in self.cells.get(key, {}).items():
+                yield sid, point
+
+    def everything(self):
+        for points in self.cells.values():
+            for sid, point in points.items():
+                yield sid, point
+
+    def within(self, lat, lon, km):
+        self.sync()
+        size = app.config['SITE_INDEX_CELL']
+        # Rings needed to cover the radius, using the narrower of the cell
+        # sides at this latitude
+        side = 111.2 * size * max(math.cos(math.radians(abs(lat) +
+                                                        km / 111.2)), 0.01)
+        rings = int(math.ceil(km / side))
+        res = []
+        with self.lock:
+            # Past the number of occupied cells, walking rings costs more
+            # than looking at every site
+            if (2 * rings + 1) ** 2 > len(self.cells):
+                points = self.everything()
+            else:
+                points = (p for ring in range(rings + 1)
+                          for p in self.candidates(lat, lon, ring))
+            for sid, (plat, plon) in points:
+                d = haversine(lat, lon, plat, plon)
+                if d <= km:
+                    res.append((d, sid))
+        return [(sid, d) for d, sid in sorted(res)]
+
+    def nearest(self, lat, lon, k):
+        # Grow rings until the k-th best is closer than anything an
+        # unvisited ring could hold
+        self.sync()
+        size = app.config['SITE_INDEX_CELL']
+        side = 111.2 * size * max(math.cos(math.radians(min(abs(lat), 89))),
+                                  0.01)
+        found = []
+        with self.lock:
+            total = len(self.sites)
+            ring = 0
+            while len(found) < total:
+                if (2 * ring + 1) ** 2 > len(self.cells):
+                    # Far from the sites, scan them all, as in within()
+                    found = sorted((haversine(lat, lon, plat, plon), sid)
+                                   for sid, (plat, plon) in self.everything())
+                    break
+                for sid, (plat, plon) in self.candidates(lat, lon, ring):
+                    found.append((haversine(lat, lon, plat, plon), sid))
+                found.sort()
+                if len(found) >= k and found[k - 1][0] <= ring * side:
+                    break
+                ring += 1
+                if ring * side > math.pi * EARTH_RADIUS_KM:
+                    break
+        return [(sid, d) for d, sid in found[:k]]
+
+
+site_index = SiteIndex()
+
+
+def point_args():
+    try:
+        return (float(fk.request.args['lat']),
+                float(fk.request.args['lon']))
+    except (KeyError, ValueError):
+        fk.abort(400)
+
+
+def count_arg():
+    # ?k=, how many results to return, at least one
+    try:
+        k = int(fk.request.args.get('k', 10))
+    except ValueError:
+        fk.abort(400)
+    if k < 1:
+        fk.abort(400)
+    return k
+
+
+def radius_arg():
+    try:
+        radius = float(fk.request.args['radius_km'])
+    except ValueError:
+        fk.abort(400)
+    if not 0 <= radius <= app.config['SITE_INDEX_MAX_KM']:
+        fk.abort(400)
+    return radius
+
+
+@app.route('/api/v1/sites/near')
+@fk_lg.login_required
+def api_sites_near():
+    # ?lat=&lon= with either radius_km= or k= (default 10)
+    lat, lon = point_args()
+    if 'radius_km' in fk.request.args:
+        hits = site_index.within(lat, lon, radius_arg())
+    else:
+        hits = site_index.nearest(lat, lon, count_arg())
+    sites = {s.sid: s for s in
+             Site.query.filter(Site.sid.in_([sid for sid, _ in hits]))}
+    return fk.jsonify({'sites': [dict(sites[sid].to_dict(),
+                                      distance_km=round(d, 3))
+                                 for sid, d in hits if sid in sites]})
+
+
+@app.route('/api/v1/orders/near')
+@fk_lg.login_required
+def api_orders_near():
+    # The k open orders closest to ?lat=&lon=, widening the site search
+    # until enough sites with open orders turn up
+    lat, lon = point_args()
+    k = count_arg()
+    wanted = k
+    while True:
+        hits = site_index.nearest(lat, lon, wanted)
+        distance = dict(hits)
+        found = order_query().filter(Order.sid.in_(list(distance)),
+                                     Order.status.in_(OPEN_STATUSES)).all()
+        if len(found) >= k or len(hits) < wanted:
+            break
+        wanted *= 2
+    found.sort(key=lambda o: (distance[o.sid], o.oid))
+    return fk.jsonify({'orders': [dict(o.to_dict(),
+                                       distance_km=round(distance[o.sid], 3))
+                                  for o in found[:k]]})
+###############################################################################
+
+# Part Search #################################################################
+
+
+def search_words(text):
+    return re.findall(r'\w+', (text or '').lower())
+
+
+def search_keys(word, query=False):
+    # Words are indexed by their trigrams plus a leading space marker, so
+    # ' ab' means "a word starting with ab". Query terms shorter than three
+    # characters only match at the start of a word.
+    if query:
+        if len(word) < 3:
+            return {' ' + word}
+        return {word[i:i + 3] for i in range(len(word) - 2)}
+    padded = ' ' + word
+    keys = {padded[:2]}
+    keys.update(padded[i:i + 3] for i in range(len(padded) - 2))
+    return keys
+
+
+class PartIndex(SyncedIndex):
+    # Trigram postings over live part names and descriptions, for the
+    # order form's search box
+    model = Part
+    config = 'PART_INDEX'
+
+    def clear(self):
+        self.parts = {}
+        self.postings = {}
+
+    def columns(self):
+        return Part.pid, Part.name, Part.description, Part.deleted
+
+    def apply(self, pid, name, description, deleted):
+        self.drop(pid)
+        if deleted:
+            return
+        name = ' ' + ' '.join(search_words(name))
+        text = name + ' ' + ' '.join(search_words(description))
+        keys = set()
+        for word in text.split():
+            keys.update(search_keys(word))
+        self.parts[pid] = (name, text, keys)
+        for key in keys:
+            self.postings.setdefault(key, set()).add(pid)
+
+    def drop(self, pid):
+        entry = self.parts.pop(pid, None)
+        if entry is None:
+            return
+        for key in entry[2]:
+            self.postings[key].discard(pid)
+            if not self.postings[key]:
+                del self.postings[key]
+
+    def search(self, q, limit):
+        terms = search_words(q)
+        if not terms:
+            return []
+        self.sync()
+        with self.lock:
+            keys = set()
+            for term in terms:
+                keys.update(search_keys(term, query=True))
+            postings = sorted((self.postings.get(k, set()) for k in keys),
+                              key=len)
+            found = set(postings[0]).intersection(*postings[1:])
+            # Trigrams can match across words, so check each term properly.
+            # Rank name prefix matches, then name matches, then the rest.
+            needles = [' ' + t if len(t) < 3 else t for t in terms]
+            ranked = []
+            for pid in found:
+                name, text, _ = self.parts[pid]
+                if not all(n in text for n in needles):
+                    continue
+                if name.startswith(' ' + terms[0]):
+                    rank = 0
+                elif all(n in name for n in needles):
+                    rank = 1
+                else:
+                    rank = 2
+                ranked.append((rank, name, pid))
+        return [pid for _, _, pid in sorted(ranked)[:limit]]
+
+
+part_index = PartIndex()
+
+
+@app.route('/api/v1/parts/search')
+@fk_lg.login_required
+def api_parts_search():
+    # Top matches for ?q=, with live stock figures for the order form
+    limit = fk.request.args.get('limit', app.config['PART_SEARCH_LIMIT'],
+                                type=int)
+    limit = max(1, min(limit, app.config['MAX_PAGE_SIZE']))
+    pids = part_index.search(fk.request.args.get('q', ''), limit)
+    parts = {p.pid: p for p in Part.query.filter(Part.pid.in_(pids))} \
+        if pids else {}
+    return fk.jsonify({'parts': [dict(parts[pid].to_dict(),
+                                      available=(parts[pid].stock or 0) -
+                                      parts[pid].reserved)
+                                 for pid in pids if pid in parts]})
+###############################################################################
+
+# Reports #####################################################################
+
+
+REPORT_GRAINS = ['day', 'week', 'month']
+REPORT_DIMENSIONS = {'client': Client, 'site': Site, 'part': Part,
+                     'all': None}
+REPORT_CHUNK = 500
+
+
+def period_start(day, grain):
+    if grain == 'week':
+        return day - dt.timedelta(days=day.weekday())
+    if grain == 'month':
+        return day.replace(day=1)
+    return day
+
+
+def line_fact(row):
+    # What a line contributes now: (day, cid, sid, pid, status, quantity,
+    # revenue), or None if it shouldn't count
+    otpid, oid, pid, quantity, price, deleted, o_deleted, due, cid, sid, \
+        status = row
+    day = parse_day(due)
+    if deleted or o_deleted or day is None or not quantity:
+        return None
+    revenue = (decimal.Decimal(quantity) *
+               decimal.Decimal(str(price or 0))).quantize(
+                   decimal.Decimal('0.01'))
+    return day, cid, sid, pid, status or '', quantity, revenue
+
+
+def fact_buckets(fact):
+    day, cid, sid, pid, status = fact[:5]
+    members = {'client': cid, 'site': sid, 'part': pid, 'all': 0}
+    for grain in REPORT_GRAINS:
+        period = period_start(day, grain)
+        for dimension, member in members.items():
+            if member is not None:
+                yield grain, dimension, period, member, status
+
+
+def refresh_reports():
+    # Bring report_rollup up to date with the orders and lines changed
+    # since the last refresh. Each line's contribution is recomputed and
+    # compared with its report_lines snapshot, so going over a row twice is
+    # harmless; the lookback only has to cover commit delay. Returns the
+    # number of lines whose contribution changed.
+    started = dt.datetime.now(dt.timezone.utc)
+    if db.engine.dialect.name == 'sqlite':
+        started = started.replace(tzinfo=None)
+    # Refreshers queue on the state row so deltas aren't applied twice
+    state = ReportState.query.filter_by(name='rollup') \
+        .with_for_update().first()
+    if state is None:
+        state = ReportState(name='rollup')
+        db.session.add(state)
+    rebuild = state.watermark is None
+    if rebuild:
+        ReportRollup.query.delete()
+        ReportLine.query.delete()
+        oids = [oid for (oid,) in db.session.query(Order.oid)]
+    else:
+        since = db.literal(str(state.watermark - dt.timedelta(
+            seconds=app.config['CHANGE_FEED_LAG'])), db.String)
+        oids = {oid for (oid,) in db.session.query(Order.oid)
+                .filter(Order.time_modified >= since)}
+        oids.update(oid for (oid,) in db.session.query(OrderToPart.oid)
+                    .filter(OrderToPart.time_modified >= since))
+        oids = sorted(o for o in oids if o is not None)
+    deltas = collections.defaultdict(lambda: [0, decimal.Decimal(0), 0])
+    changed = 0
+    for i in range(0, len(oids), REPORT_CHUNK):
+        chunk = oids[i:i + REPORT_CHUNK]
+        current = db.session.query(
+            OrderToPart.otpid, OrderToPart.oid, OrderToPart.pid,
+            OrderToPart.quantity, OrderToPart.price, OrderToPart.deleted,
+            Order.deleted, Order.due, Order.cid, Order.sid, Order.status) \
+            .join(Order, Order.oid == OrderToPart.oid) \
+            .filter(OrderToPart.oid.in_(chunk))
+        facts = {}
+        line_oids = {}
+        for row in current:
+            facts[row[0]] = line_fact(row)
+            line_oids[row[0]] = row[1]
+        snapshots = {r.otpid: r for r in
+                     ReportLine.query.filter(ReportLine.oid.in_(chunk))}
+        stale = []
+        fresh = []
+        for otpid in set(facts) | set(snapshots):
+            old = snapshots.get(otpid)
+            if old is not None:
+                old = (old.day, old.cid, old.sid, old.pid, old.status,
+                       old.quantity, old.revenue)
+            new = facts.get(otpid)
+            if old == new:
+                continue
+            changed += 1
+            for fact, sign in ((old, -1), (new, 1)):
+                if fact is None:
+                    continue
+                for bucket in fact_buckets(fact):
+                    delta = deltas[bucket]
+                    delta[0] += sign * fact[5]
+                    delta[1] += sign * fact[6]
+                    delta[2] += sign
+            if otpid in snapshots:
+                stale.append(otpid)
+            if new is not None:
+                fresh.append(dict(zip(('day', 'cid', 'sid', 'pid', 'status',
+                                       'quantity', 'revenue'), new),
+                                  otpid=otpid, oid=line_oids[otpid]))
+        if stale:
+            ReportLine.query.filter(ReportLine.otpid.in_(stale)) \
+                .delete(synchronize_session=False)
+        if fresh:
+            db.session.execute(ReportLine.__table__.insert(), fresh)
+    apply_rollup_deltas(deltas, existing=not rebuild)
+    state.watermark = started
+    db.session.commit()
+    return changed
+
+
+def apply_rollup_deltas(deltas, existing=True):
+    # Add {bucket: [quantity, revenue, lines]} into report_rollup, dropping
+    # buckets that no longer have any lines. existing=False skips looking
+    # up current totals when the table starts out empty.
+    deltas = {b: d for b, d in deltas.items() if d[2] or d[0] or d[1]}
+    if not deltas:
+        return
+    table = ReportRollup.__table__
+    c = table.c
+    groups = collections.defaultdict(list)
+    if existing:
+        for bucket in deltas:
+            groups[bucket[:2]].append(bucket)
+    existing = {}
+    for (grain, dimension), buckets in groups.items():
+        for i in range(0, len(buckets), REPORT_CHUNK):
+            part = buckets[i:i + REPORT_CHUNK]
+            query = db.session.query(ReportRollup).filter(
+                ReportRollup.grain == grain,
+                ReportRollup.dimension == dimension,
+                ReportRollup.period.in_({b[2] for b in part}),
+                ReportRollup.member.in_({b[3] for b in part}),
+                ReportRollup.status.in_({b[4] for b in part}))
+            for r in query:
+                existing[(r.grain, r.dimension, r.period, r.member,
+                          r.status)] = (r.quantity, r.revenue, r.lines)
+    inserts, updates, deletes = [], [], []
+    for bucket, (quantity, revenue, lines) in deltas.items():
+        keys = dict(zip(('_grain', '_dimension', '_period', '_member',
+                         '_status'), bucket))
+        old = existing.get(bucket)
+        if old is None:
+            inserts.append(dict(zip(('grain', 'dimension', 'period',
+                                     'member', 'status'), bucket),
+                                quantity=quantity, revenue=revenue,
+                                lines=lines))
+        elif old[2] + lines <= 0:
+            deletes.append(keys)
+        else:
+            updates.append(dict(keys, quantity=old[0] + quantity,
+                                revenue=old[1] + revenue,
+                                lines=old[2] + lines))
+    match = db.and_(c.grain == db.bindparam('_grain'),
+                    c.dimension == db.bindparam('_dimension'),
+                    c.period == db.bindparam('_period'),
+                    c.member == db.bindparam('_member'),
+                    c.status == db.bindparam('_status'))
+    if inserts:
+        db.session.execute(table.insert(), inserts)
+    if updates:
+        db.session.execute(table.update().where(match), updates)
+    if deletes:
+        db.session.execute(table.delete().where(match), deletes)
+
+
+last_report_refresh = {'time': 0}
+
+
+def reports_up_to_date():
+    # Refresh the rollups if this process hasn't for REPORT_REFRESH
+    # seconds. Always against the primary, a lagging replica could let the
+    # watermark pass rows it hasn't received yet.
+    now = time.time()
+    if now - last_report_refresh['time'] < app.config['REPORT_REFRESH']:
+        return
+    replica = fk.g.get('replica')
+    fk.g.replica = False
+    try:
+        refresh_reports()
+    finally:
+        fk.g.replica = replica
+    last_report_refresh['time'] = now
+
+
+def report_args():
+    args = fk.request.args
+    by = args.get('by', 'client')
+    grain = args.get('grain', 'month')
+    if by not in REPORT_DIMENSIONS or grain not in REPORT_GRAINS:
+        fk.abort(400)
+    start = parse_day(args.get('start')) if args.get('start') else None
+    end = parse_day(args.get('end')) if args.get('end') else None
+    return {'by': by, 'grain': grain, 'start': start, 'end': end,
+            'backlog': args.get('backlog') in ('1', 'true', 'on')}
+
+
+def report_rows(by, grain, start=None, end=None, backlog=False):
+    # Quantity, revenue and line count per period and member of `by`.
+    # Backlog counts only orders that are still open.
+    r = ReportRollup
+    query = db.session.query(
+        r.period, r.member, db.func.sum(r.quantity),
+        db.func.sum(r.revenue), db.func.sum(r.lines)) \
+        .filter(r.grain == grain, r.dimension == by)
+    if start:
+        query = query.filter(r.period >= period_start(start, grain))
+    if end:
+        query = query.filter(r.period <= end)
+    if backlog:
+        query = query.filter(r.status.in_(OPEN_STATUSES))
+    rows = query.group_by(r.period, r.member) \
+        .order_by(r.period, r.member).all()
+    model = REPORT_DIMENSIONS[by]
+    names = {}
+    if model is not None and rows:
+        key = model.__mapper__.primary_key[0]
+        label = Site.address if model is Site else model.name
+        names = dict(db.session.query(key, label)
+                     .filter(key.in_({row[1] for row in rows})))
+    return [{'period': str(period), 'id': member,
+             'name': names.get(member, '') if model else 'All',
+             'quantity': int(quantity or 0),
+             'revenue': float(revenue or 0), 'lines': int(lines or 0)}
+            for period, member, quantity, revenue, lines in rows]
+
+
+@app.route('/reports/')
+@fk_lg.login_required
+@replica_reads
+def reports():
+    reports_up_to_date()
+    args = report_args()
+    return fk.render_template('reports.html', args=args,
+                              rows=report_rows(**args),
+                              dimensions=sorted(REPORT_DIMENSIONS),
+                              grains=REPORT_GRAINS)
+
+
+@app.route('/api/v1/reports')
+@fk_lg.login_required
+@replica_reads
+def api_reports():
+    # ?by=client|site|part|all&grain=day|week|month&start=&end=&backlog=1
+    reports_up_to_date()
+    args = report_args()
+    rows = report_rows(**args)
+    return fk.jsonify(dict(args, start=args['start'] and str(args['start']),
+                           end=args['end'] and str(args['end']), rows=rows))
+###############################################################################
+
+# Instrumentation #############################################################
+
+
+class RouteMetrics(object):
+    # Keeps the last INSTRUMENT_SAMPLES requests per endpoint and reports
+    # percentiles over them
+    fields = ['wall', 'db', 'queries', 'templates', 'http']
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.samples = {}
+
+    def record(self, endpoint, sample):
+        with self.lock:
+            if endpoint not in self.samples:
+                self.samples[endpoint] = collections.deque(
+                    maxlen=app.config['INSTRUMENT_SAMPLES'])
+            self.samples[endpoint].append(sample)
+
+    def summary(self):
+        with self.lock:
+            samples = {k: list(v) for k, v in self.samples.items()}
+        res = {}
+        for endpoint, rows in samples.items():
+            res[endpoint] = {'count': len(rows)}
+            for field in self.fields:
+                values = sorted(r[field] for r in rows)
+                res[endpoint][field] = {
+                    'p50': percentile(values, 50),
+                    'p95': percentile(values, 95),
+                    'p99': percentile(values, 99),
+                    'max': values[-1]}
+        return res
+
+    def reset(self):
+        with self.lock:
+            self.samples = {}
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    return values[int(round(q / 100.0 * (len(values) - 1)))]
+
+
+route_metrics = RouteMetrics()
+
+
+def current_metrics():
+    # Only requests that started while INSTRUMENT was on are measured
+    if fk.has_request_context():
+        return getattr(fk.g, 'metrics', None)
+    return None
+
+
+@contextlib.contextmanager
+def measure(field):
+    started = time.time()
+    try:
+        yield
+    finally:
+        metrics = current_metrics()
+        if metrics is not None:
+            metrics[field] += (time.time() - started) * 1000
+
+
+@app.before_request
+def start_metrics():
+    if app.config['INSTRUMENT']:
+        fk.g.metrics = {'started': time.time(), 'wall': 0, 'db': 0,
+                        'queries': 0, 'templates': 0, 'http': 0}
+
+
+@app.after_request
+def record_metrics(response):
+    metrics = current_metrics()
+    if metrics is None:
+        return response
+    metrics['wall'] = (time.time() - metrics.pop('started')) * 1000
+    endpoint = '{0} {1}'.format(fk.request.method,
+                                fk.request.endpoint or 'unknown')
+    route_metrics.record(endpoint, metrics)
+    if not app.config['INSTRUMENT_LOG']:
+        return response
+    print('route={0} status={1} wall={2:.1f}ms db={3:.1f}ms queries={4} '
+          'templates={5:.1f}ms http={6:.1f}ms'.format(
+              endpoint, response.status_code, metrics['wall'],
+              metrics['db'], metrics['queries'], metrics['templates'],
+              metrics['http']))
+    return response
+
+
+@db.event.listens_for(Engine, 'before_cursor_execute')
+def start_query_timer(conn, cursor, statement, parameters, context,
+                      executemany):
+    context.query_started = time.time()
+
+
+@db.event.listens_for(Engine, 'after_cursor_execute')
+def stop_query_timer(conn, cursor, statement, parameters, context,
+                     executemany):
+    metrics = current_metrics()
+    if metrics is not None:
+        metrics['db'] += (time.time() - context.query_started) * 1000
+        metrics['queries'] += 1
+
+
+if fk.signals_available:
+    def start_template_timer(sender, template, context, **extra):
+        metrics = current_metrics()
+        if metrics is not None:
+            metrics['template_started'] = time.time()
+
+    def stop_template_timer(sender, template, context, **extra):
+        metrics = current_metrics()
+        if metrics is not None and 'template_started' in metrics:
+            started = metrics.pop('template_started')
+            metrics['templates'] += (time.time() - started) * 1000
+
+    fk.before_render_template.connect(start_template_timer, app)
+    fk.template_rendered.connect(stop_template_timer, app)
+
+
+@app.route('/admin/metrics')
+@fk_lg.login_required
+def metrics_summary():
+    return fk.jsonify(route_metrics.summary())
+
+
+@app.route('/admin/pool')
+@fk_lg.login_required
+def pool_status():
+    # Connection pool usage for this worker process
+    pool = db.engine.pool
+    res = {'pid': os.getpid(), 'pool': type(pool).__name__,
+           'status': pool.status()}
+    for key in ('size', 'checkedin', 'checkedout', 'overflow'):
+        if hasattr(pool, key):
+            res[key] = getattr(pool, key)()
+    return fk.jsonify(res)
+###############################################################################
+
+# Commands ####################################################################
+
+
+# Free text due dates migrate_order_due() understands, the last two as
+# written by the old demo_data_csv.py ('4 May 2018', '25 December 2018')
+LEGACY_DUE_FORMATS = ('%Y-%m-%d', '%m/%d/%Y', '%m/%d/%y', '%d %B %Y',
+                      '%d %b %Y')
+
+
+def parse_legacy_due(due):
+    text = (due or '').strip()
+    # Also try the first ten characters, for values with a time on the end
+    for fmt in LEGACY_DUE_FORMATS:
+        for candidate in (text, text[:10]):
+            try:
+                return str(dt.datetime.strptime(candidate, fmt).date())
+            except ValueError:
+                pass
+    return None
+
+
+def migrate_order_due(force=False):
+    # orders.due used to be free text. Rewrite whatever parses as a date to
+    # YYYY-MM-DD, then change the column type. SQLite keeps dates as that
+    # text, so there the rewrite is all it needs. Values that don't parse
+    # stop the upgrade unless force is set, which clears them.
+    columns = {c['name']: c['type']
+               for c in db.inspect(db.engine).get_columns('orders')}
+    if not isinstance(columns.get('due'), db.String):
+        return
+    updates = []
+    unreadable = []
+    for oid, due in db.session.execute('SELECT oid, due FROM orders'):
+        day = parse_legacy_due(due)
+        if day != due:
+            if due and due.strip() and day is None:
+                unreadable.append((oid, due))
+            updates.append({'oid': oid, 'due': day})
+    for oid, due in unreadable:
+        print('order {0}: {1}unreadable due {2!r}'.format(
+            oid, 'clearing ' if force else '', due))
+    if unreadable and not force:
+        db.session.rollback()
+        raise click.ClickException(
+            '{0} due dates could not be read; correct them or rerun with '
+            '--force to clear them'.format(len(unreadable)))
+    if updates:
+        print('rewriting {0} due dates'.format(len(updates)))
+        db.session.execute('UPDATE orders SET due = :due WHERE oid = :oid',
+                           updates)
+    if db.engine.dialect.name != 'sqlite':
+        print('changing orders.due to DATE')
+        db.session.execute('ALTER TABLE orders ALTER COLUMN due TYPE DATE '
+                           'USING due::date')
+    db.session.commit()
+
+
+def migrate_coordinates():
+    # Coordinates used to be NUMERIC(5), which Postgres rounds to whole
+    # degrees, and baseline sites were stored with lat and lon swapped.
+    # Widen the columns, then send every site without a geocode status (or
+    # with rounded coordinates) and the rounded cache entries back through
+    # the geocoder.
+    inspector = db.inspect(db.engine)
+    rounded = False
+    for table in (Site.__table__, GeocodeCache.__table__):
+        for column in inspector.get_columns(table.name):
+            if column['name'] not in ('lat', 'lon') or \
+                    getattr(column['type'], 'scale', None) in (None, 6):
+                continue
+            print('changing {0}.{1} to NUMERIC(9, 6)'.format(
+                table.name, column['name']))
+            db.session.execute('ALTER TABLE {0} ALTER COLUMN {1} TYPE '
+                               'NUMERIC(9, 6)'.format(table.name,
+                                                      column['name']))
+            rounded = True
+    stale = Site.query.filter(Site.geocode_status.is_(None))
+    if rounded:
+        stale = Site.query.filter(db.or_(Site.geocode_status.is_(None),
+                                         Site.lat.isnot(None)))
+        GeocodeCache.query.delete()
+    count = stale.update({Site.lat: None, Site.lon: None,
+                          Site.geocode_status: 'pending'},
+                         synchronize_session=False)
+    db.session.commit()
+    if count:
+        print('geocoding {0} sites again'.format(count))
+        geocode_pending_sites()
+
+
+def upgrade_db(force=False):
+    # Bring an existing database up to the models: create missing tables,
+    # then add any missing columns and indexes to the ones already there.
+    # force lets migrate_order_due() clear dates it can't read.
+    db.create_all()
+    migrate_order_due(force)
+    inspector = db.inspect(db.engine)
+    added = set()
+    for table in db.metadata.sorted_tables:
+        columns = {c['name'] for c in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in columns:
+                continue
+            print('adding column {0}.{1}'.format(table.name, column.name))
+            ddl = 'ALTER TABLE {0} ADD COLUMN {1} {2}'.format(
+                table.name, column.name,
+                column.type.compile(dialect=db.engine.dialect))
+            if column.server_default is not None:
+                ddl += " DEFAULT '{0}'".format(column.server_default.arg)
+            db.engine.execute(ddl)
+            added.add((table.name, column.name))
+        indexes = {i['name'] for i in inspector.get_indexes(table.name)}
+        for name in RETIRED_INDEXES.get(table.name, []):
+            if name in indexes:
+                print('dropping index {0}'.format(name))
+                db.engine.execute('DROP INDEX {0}'.format(name))
+        for index in table.indexes:
+            if index.name not in indexes:
+                print('creating index {0}'.format(index.name))
+                index.create(bind=db.engine)
+    for model in ENTITIES.values():
+        backfill_time_modified(model)
+    migrate_coordinates()
+    if ('parts', 'reserved') in added:
+        # Added as 0 everywhere, count up the live order lines
+        print('{0} parts corrected'.format(reconcile_reserved()))
+    sync_id_sequences()
+
+
+def explain_routes(paths):
+    # Run each route as the first user and print the plan of every SELECT
+    # it issued, to check the indexes above are being used
+    statements = []
+
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith('SELECT'):
+            statements.append((statement, parameters))
+    if db.engine.dialect.name == 'sqlite':
+        prefix = 'EXPLAIN QUERY PLAN '
+    else:
+        prefix = 'EXPLAIN '
+    client = app.test_client()
+    with client.session_transaction() as sess:
+        sess['user_id'] = str(User.query.order_by(User.uid).first().uid)
+        sess['_fresh'] = True
+    for path in paths:
+        del statements[:]
+        db.event.listen(db.engine, 'before_cursor_execute', capture)
+        try:
+            status = client.get(path).status_code
+        finally:
+            db.event.remove(db.engine, 'before_cursor_execute', capture)
+        print('=== {0} ({1}, {2} queries)'.format(path, status,
+                                                  len(statements)))
+        for statement, parameters in statements:
+            print(' '.join(statement.split()))
+            for row in db.engine.execute(prefix + statement, parameters):
+                print('    ' + ' | '.join(str(v) for v in row))
+
+
+@app.cli.command('upgrade-db')
+@click.option('--force', is_flag=True,
+              help='clear order due dates that cannot be read')
+def upgrade_db_command(force):
+    upgrade_db(force)
+
+
+@app.cli.command('sync-sequences')
+def sync_sequences_command():
+    sync_id_sequences()
+
+
+@app.cli.command('reconcile-reserved')
+def reconcile_reserved_command():
+    print('{0} parts corrected'.format(reconcile_reserved()))
+
+
+@app.cli.command('refresh-reports')
+@click.option('--rebuild', is_flag=True,
+              help='discard the rollups and build them from scratch')
+def refresh_reports_command(rebuild):
+    if rebuild:
+        ReportState.query.delete()
+    started = time.time()
+    changed = refresh_reports()
+    print('{0} order lines updated in {1:.1f}s'.format(
+        changed, time.time() - started))
+
+
+@app.cli.command('import-csv')
+@click.argument('entity', type=click.Choice(sorted(ENTITIES)))
+@click.argument('path', type=click.Path(exists=True))
+@click.option('--no-geocode', is_flag=True)
+def import_csv_command(entity, path, no_geocode):
+    with open(path) as fid:
+        count = import_csv(entity, fid, geocode=not no_geocode)
+    print('imported {0} {1}'.format(count, entity))
+
+
+@app.cli.command('export-csv')
+@click.argument('entity', type=click.Choice(sorted(ENTITIES)))
+@click.argument('path', type=click.Path())
+def export_csv_command(entity, path):
+    with open(path, 'w') as fid:
+        for chunk in export_csv(entity):
+            fid.write(chunk)
+
+
+@app.cli.command('changes')
+@click.option('--since', default=None)
+@click.option('--limit', type=int, default=None)
+def changes_command(since, limit):
+    changes, cursor = change_feed(since, limit)
+    for change in changes:
+        print(json.dumps(change))
+    print('next: {0}'.format(cursor))
+
+
+@app.cli.command('explain')
+@click.argument('paths', nargs=-1)
+def explain_command(paths):
+    explain_routes(paths or ['/', '/clients/', '/sites/', '/parts/',
+                             '/orders/', '/order/1'])
 ###############################################################################
 
 
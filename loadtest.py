@@ -0,0 +1,185 @@
+# Load test for Hermes under gunicorn, comparing worker and pool settings.
+#
+# Each combination is WORKERSxTHREADS:POOL+OVERFLOW. The script starts
+# gunicorn with gunicorn_config.py for each one, drives it from --clients
+# concurrent sessions for --duration seconds and reports throughput and
+# latency. Load data with benchmark.py first, against the same database:
+#     python benchmark.py --db postgresql://localhost/hermes_bench \
+#         --iterations 0
+#     python loadtest.py --db postgresql://localhost/hermes_bench \
+#         --combos 1x1:1+0,2x4:5+0,2x4:2+0,4x8:10+5 --clients 32
+import argparse
+import datetime as dt
+import json
+import os
+import subprocess
+import threading
+import time
+
+import requests
+
+os.environ.setdefault('ENV', 'loadtest')
+os.environ.setdefault('FLASK_KEY', 'loadtest')
+os.environ.setdefault('DATABASE_URL', 'sqlite:///bench.db')
+
+PATHS = ['/', '/orders/', '/parts/', '/sites/', '/api/v1/orders?size=50',
+         '/api/v1/parts/search?q=part+1']
+
+
+def parse_combo(text):
+    # '2x4:5+5' -> workers 2, threads 4, pool 5, overflow 5
+    shape, _, pool = text.partition(':')
+    workers, _, threads = shape.partition('x')
+    size, _, overflow = (pool or '5+5').partition('+')
+    return {'workers': int(workers), 'threads': int(threads or 1),
+            'pool': int(size), 'overflow': int(overflow or 0)}
+
+
+def ensure_user(args):
+    # Create the load test login if the dataset doesn't have it
+    os.environ['DATABASE_URL'] = args.db
+    import hermes
+    with hermes.app.app_context():
+        user = hermes.User.query.filter_by(username=args.user).first()
+        if user is None:
+            user = hermes.User(username=args.user,
+                               email='{0}@example.com'.format(args.user))
+            user.set_pw(args.password)
+            hermes.db.session.add(user)
+            hermes.db.session.commit()
+
+
+def start_server(args, combo):
+    env = dict(os.environ, DATABASE_URL=args.db,
+               WEB_WORKER_CLASS=args.worker_class,
+               WEB_CONCURRENCY=str(combo['workers']),
+               WEB_THREADS=str(combo['threads']),
+               WEB_CONNECTIONS=str(args.clients),
+               DB_POOL_SIZE=str(combo['pool']),
+               DB_MAX_OVERFLOW=str(combo['overflow']),
+               # The load is read only, so a per worker lru cache is safe
+               PAGE_CACHE='0' if args.no_page_cache else '1',
+               PORT=str(args.port))
+    # Access log goes to stdout and is dropped, errors still show
+    server = subprocess.Popen(['gunicorn', 'wsgi:app', '-c',
+                               'gunicorn_config.py'],
+                              env=env, stdout=subprocess.DEVNULL)
+    base = 'http://127.0.0.1:{0}'.format(args.port)
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            if requests.get(base + '/login', timeout=1).status_code == 200:
+                return server, base
+        except requests.ConnectionError:
+            pass
+        time.sleep(0.2)
+    server.terminate()
+    raise RuntimeError('gunicorn did not start for {0}'.format(combo))
+
+
+def login(base, args):
+    session = requests.Session()
+    r = session.post(base + '/login', data={'username': args.user,
+                                            'password': args.password})
+    if r.status_code != 200 or r.url.endswith('/login'):
+        raise RuntimeError('could not log in as {0}'.format(args.user))
+    return session.cookies
+
+
+def drive(base, cookies, args, results, offset):
+    session = requests.Session()
+    session.cookies.update(cookies)
+    latencies = []
+    errors = 0
+    i = offset
+    deadline = time.time() + args.duration
+    while time.time() < deadline:
+        path = PATHS[i % len(PATHS)]
+        i += 1
+        started = time.time()
+        try:
+            r = session.get(base + path, timeout=args.timeout,
+                            allow_redirects=False)
+            ok = r.status_code == 200
+        except requests.RequestException:
+            ok = False
+        if ok:
+            latencies.append(1000 * (time.time() - started))
+        else:
+            errors += 1
+    results.append((latencies, errors))
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    return values[int(round(q / 100.0 * (len(values) - 1)))]
+
+
+def run_combo(args, combo):
+    server, base = start_server(args, combo)
+    try:
+        cookies = login(base, args)
+        results = []
+        clients = [threading.Thread(target=drive,
+                                    args=(base, cookies, args, results, n))
+                   for n in range(args.clients)]
+        for t in clients:
+            t.start()
+        for t in clients:
+            t.join()
+    finally:
+        server.terminate()
+        server.wait()
+    latencies = sorted(ms for res, _ in results for ms in res)
+    return dict(combo, requests=len(latencies),
+                errors=sum(e for _, e in results),
+                rps=len(latencies) / float(args.duration),
+                p50=percentile(latencies, 50), p95=percentile(latencies, 95),
+                p99=percentile(latencies, 99))
+
+
+def report(rows):
+    print('{0:<16}{1:>9}{2:>9}{3:>10}{4:>10}{5:>10}'.format(
+        'workers/pool', 'req/s', 'errors', 'p50 ms', 'p95 ms', 'p99 ms'))
+    for row in rows:
+        label = '{0}x{1}:{2}+{3}'.format(row['workers'], row['threads'],
+                                         row['pool'], row['overflow'])
+        print('{0:<16}{1:>9.1f}{2:>9}{3:>10.1f}{4:>10.1f}{5:>10.1f}'.format(
+            label, row['rps'], row['errors'], row['p50'] or 0,
+            row['p95'] or 0, row['p99'] or 0))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compare gunicorn worker and pool settings')
+    parser.add_argument('--db', default=os.environ['DATABASE_URL'])
+    parser.add_argument('--combos', default='1x1:1+0,2x4:5+0,2x4:2+0,4x4:5+5',
+                        help='comma separated WORKERSxTHREADS:POOL+OVERFLOW')
+    parser.add_argument('--worker-class', default='gthread',
+                        choices=['gthread', 'gevent'])
+    parser.add_argument('--clients', type=int, default=16)
+    parser.add_argument('--duration', type=int, default=20)
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--port', type=int, default=8123)
+    parser.add_argument('--user', default='loadtest')
+    parser.add_argument('--password', default='loadtest')
+    parser.add_argument('--no-page-cache', action='store_true',
+                        help='measure the database rather than page_cache')
+    parser.add_argument('--output', help='append results as JSON lines')
+    args = parser.parse_args()
+
+    ensure_user(args)
+    rows = []
+    for text in args.combos.split(','):
+        rows.append(run_combo(args, parse_combo(text)))
+        print('finished {0}: {1:.1f} req/s'.format(text, rows[-1]['rps']))
+    report(rows)
+    if args.output:
+        with open(args.output, 'a') as fid:
+            fid.write(json.dumps({'time': str(dt.datetime.utcnow()),
+                                  'args': vars(args), 'results': rows}) + '\n')
+
+
+if __name__ == '__main__':
+    main()
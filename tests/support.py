@@ -0,0 +1,38 @@
+# Shared setup for the tests: a throwaway SQLite database holding the demo
+# data, with the geocoder stubbed out. Import this before hermes.
+import os
+import sys
+import tempfile
+import unittest
+from unittest import mock
+
+DB_FILE = os.path.join(tempfile.mkdtemp(), 'hermes_test.db')
+os.environ.setdefault('ENV', 'testing')
+os.environ.setdefault('FLASK_KEY', 'testing')
+os.environ['DATABASE_URL'] = 'sqlite:///' + DB_FILE
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import hermes  # noqa: E402
+
+
+def fake_geocode(keys):
+    return {key: (41.4, -75.7) for key in keys}
+
+
+class DemoTestCase(unittest.TestCase):
+    # Reseeds the demo data once per class and logs the test client in as
+    # the first user
+
+    @classmethod
+    def setUpClass(cls):
+        hermes.app.config['TESTING'] = True
+        hermes.app.config['PAGE_CACHE'] = False
+        hermes.app.config['GEOCODE_WORKERS'] = 0
+        with mock.patch.object(hermes, 'census_geocode', fake_geocode), \
+                hermes.app.app_context():
+            hermes.reinitialize_demo_db()
+            uid = hermes.User.query.order_by(hermes.User.uid).first().uid
+        cls.client = hermes.app.test_client()
+        with cls.client.session_transaction() as sess:
+            sess['user_id'] = str(uid)
+            sess['_fresh'] = True
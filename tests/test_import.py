@@ -0,0 +1,44 @@
+# CSV upload through /import/<entity>. Run from the repository root with
+#     python -m unittest discover tests
+import io
+import json
+import unittest
+
+from support import DemoTestCase, hermes
+
+
+class ImportUploadTest(DemoTestCase):
+
+    def upload(self, entity, text):
+        return self.client.post(
+            '/import/{0}'.format(entity),
+            data={'file': (io.BytesIO(text.encode('utf8')),
+                           '{0}.csv'.format(entity))},
+            content_type='multipart/form-data')
+
+    def test_upload_clients(self):
+        with hermes.app.app_context():
+            before = hermes.Client.query.count()
+        r = self.upload('clients', 'name,description\n'
+                                   'Bob Vance,Vance Refrigeration\n'
+                                   'Zoë Ferris,Ferris Café\n')
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(json.loads(r.data.decode('utf8'))['imported'], 2)
+        with hermes.app.app_context():
+            self.assertEqual(hermes.Client.query.count(), before + 2)
+            self.assertIsNotNone(
+                hermes.Client.query.filter_by(name='Zoë Ferris').first())
+
+    def test_reupload_export_conflicts(self):
+        exported = self.client.get('/export/order_lines.csv')
+        self.assertEqual(exported.status_code, 200)
+        with hermes.app.app_context():
+            before = hermes.OrderToPart.query.count()
+        r = self.upload('order_lines', exported.data.decode('utf8'))
+        self.assertEqual(r.status_code, 409)
+        with hermes.app.app_context():
+            self.assertEqual(hermes.OrderToPart.query.count(), before)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+# Query count checks for the list pages. Run from the repository root with
+#     python -m unittest discover tests
+import datetime as dt
+import unittest
+
+from support import DemoTestCase, hermes
+
+
+class OrderListQueryTest(DemoTestCase):
+
+    def count_queries(self, path):
+        statements = []
+
+        def count(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        with hermes.app.app_context():
+            engine = hermes.db.engine
+        # Load the user first so only the page's own queries are counted
+        self.assertEqual(self.client.get(path).status_code, 200)
+        hermes.db.event.listen(engine, 'before_cursor_execute', count)
+        try:
+            self.assertEqual(self.client.get(path).status_code, 200)
+        finally:
+            hermes.db.event.remove(engine, 'before_cursor_execute', count)
+        return len(statements)
+
+    def add_orders(self, count):
+        # A client and site per order, so lazy loading them would show up
+        with hermes.app.app_context():
+            part = hermes.Part.query.first()
+            for i in range(count):
+                client = hermes.Client(name='Client {0}'.format(i),
+                                       deleted=False)
+                site = hermes.Site(address='{0} Main St'.format(i),
+                                   lat=41.4, lon=-75.7,
+                                   geocode_status='done', deleted=False)
+                hermes.db.session.add_all([client, site])
+                hermes.db.session.flush()
+                order = hermes.Order(cid=client.cid, sid=site.sid,
+                                     due=dt.date(2018, 6, 1),
+                                     status='Order received', deleted=False)
+                hermes.db.session.add(order)
+                hermes.db.session.flush()
+                hermes.db.session.add(hermes.OrderToPart(
+                    oid=order.oid, pid=part.pid, quantity=1, price=1,
+                    deleted=False))
+            hermes.db.session.commit()
+            return hermes.Order.query.filter_by(deleted=False).count()
+
+    def test_orders_page_query_count_is_fixed(self):
+        with hermes.app.app_context():
+            few = hermes.Order.query.filter_by(deleted=False).count()
+        before = self.count_queries('/orders/')
+        many = self.add_orders(hermes.app.config['PAGE_SIZE'])
+        self.assertGreater(many, few)
+        self.assertEqual(self.count_queries('/orders/'), before)
+
+
+if __name__ == '__main__':
+    unittest.main()